@@ -0,0 +1,175 @@
+"""
+archive.py
+
+streaming archive of tweets, to save the tweets of a run and replay them
+later without the twitter api.
+
+the archive is a gzip file of json lines, one tweet._json per line,
+written in blocks of tweets as separate gzip members so it can be
+written as tweets arrive and read back a block at a time. next to it is
+an index file with one json line per tweet holding the tweet id, its
+creation time and the offset and length of the block holding it, so a
+replay of a subset of tweets only decompresses the blocks it needs.
+"""
+import logging
+log = logging.getLogger(__name__)
+
+import gzip
+import json
+import datetime
+
+import tweepy
+
+# format of created_at in the twitter json
+_TWITTER_TIME = '%a %b %d %H:%M:%S %z %Y'
+
+def indexFile(archive_file):
+    """ return the name of the index file for archive_file """
+    return archive_file + '.idx'
+
+def tweetTime(tweet_json):
+    """ return the creation time of a tweet as seconds since the epoch """
+    return datetime.datetime.strptime(tweet_json['created_at'],
+                                      _TWITTER_TIME).timestamp()
+
+class ArchiveWriter(object):
+    """
+    class to append tweets to an archive
+    """
+
+    archive_file = None
+    block_size = 200 # number of tweets per gzip member
+
+    def __init__(self,archive_file,block_size=None):
+        self.archive_file = archive_file
+        if block_size is not None:
+            self.block_size = block_size
+
+        self._f = open(archive_file,'ab')
+        self._idx = open(indexFile(archive_file),'a')
+        self._lines = []
+        self._index = []
+        self.count = 0
+
+    def write(self,tweet):
+        """ add a tweepy Status, or its json dict, to the archive """
+        try:
+            tweet_json = tweet._json
+        except AttributeError:
+            tweet_json = tweet
+
+        self._lines.append(json.dumps(tweet_json))
+        self._index.append([ tweet_json['id_str'], tweetTime(tweet_json) ])
+        self.count += 1
+
+        if len(self._lines) >= self.block_size:
+            self.flush()
+
+    def flush(self):
+        """ write the buffered tweets as one block """
+        if not self._lines:
+            return
+
+        offset = self._f.tell()
+        data = ( '\n'.join(self._lines) + '\n' ).encode('utf-8')
+        block = gzip.compress(data)
+        self._f.write(block)
+        self._f.flush()
+
+        for id_str,created in self._index:
+            self._idx.write(json.dumps({ 'id' : id_str,
+                                         'created' : created,
+                                         'offset' : offset,
+                                         'length' : len(block) }) + '\n')
+        self._idx.flush()
+
+        self._lines = []
+        self._index = []
+
+    def close(self):
+        self.flush()
+        self._f.close()
+        self._idx.close()
+        log.debug('Wrote ' + str(self.count) + ' tweets to ' + self.archive_file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+    def archived(self,tweets):
+        """ generator that writes each tweet to the archive as it passes """
+        for tweet in tweets:
+            self.write(tweet)
+            yield tweet
+
+class ArchiveReader(object):
+    """
+    class to read tweets back from an archive as tweepy Status objects
+    """
+
+    archive_file = None
+
+    def __init__(self,archive_file):
+        self.archive_file = archive_file
+
+    def _parse(self,line):
+        return tweepy.models.Status.parse(None, json.loads(line))
+
+    def _blocks(self,ids=None,start=None,end=None):
+        """
+        return the sorted (offset, length) of the blocks holding tweets that
+        match ids and the start and end times, in seconds since the epoch
+        """
+        blocks = set()
+        with open(indexFile(self.archive_file)) as f:
+            for line in f:
+                entry = json.loads(line)
+                if ids is not None and entry['id'] not in ids:
+                    continue
+                if start is not None and entry['created'] < start:
+                    continue
+                if end is not None and entry['created'] > end:
+                    continue
+                blocks.add( ( entry['offset'], entry['length'] ) )
+        return sorted(blocks)
+
+    def iterTweets(self,ids=None,start_date=None,end_date=None):
+        """
+        generator of the tweets in the archive, read lazily
+
+        ids = None - only tweets with these id strings
+        start_date = None - only tweets created at or after this datetime
+        end_date = None - only tweets created at or before this datetime
+        """
+        if ids is None and start_date is None and end_date is None:
+            # read everything as one stream
+            with gzip.open(self.archive_file,'rt',encoding='utf-8') as f:
+                for line in f:
+                    yield self._parse(line)
+            return
+
+        if ids is not None:
+            ids = set(ids)
+        start = start_date.timestamp() if start_date else None
+        end = end_date.timestamp() if end_date else None
+
+        blocks = self._blocks(ids,start,end)
+        log.debug('Reading ' + str(len(blocks)) + ' blocks from ' +\
+                  self.archive_file)
+
+        with open(self.archive_file,'rb') as f:
+            for offset,length in blocks:
+                f.seek(offset)
+                data = gzip.decompress(f.read(length)).decode('utf-8')
+                for line in data.splitlines():
+                    tweet_json = json.loads(line)
+                    if ids is not None and tweet_json['id_str'] not in ids:
+                        continue
+                    created = tweetTime(tweet_json)
+                    if start is not None and created < start:
+                        continue
+                    if end is not None and created > end:
+                        continue
+                    yield tweepy.models.Status.parse(None, tweet_json)
@@ -0,0 +1,45 @@
+"""
+atomicfile.py
+
+write files so that a reader never sees one partly written, e.g. the
+prometheus textfile collector, a search reading the face cache or the
+next run reading the state file after this one was interrupted. the
+file is written under a temporary name next to it and moved into place
+once complete.
+"""
+import logging
+log = logging.getLogger(__name__)
+
+import os
+import threading
+import contextlib
+
+def tmpName(filename):
+    """ return a temporary name next to filename unique to this thread """
+    return filename + '.' + str(os.getpid()) + '.' +\
+           str(threading.get_ident()) + '.tmp'
+
+@contextlib.contextmanager
+def atomicFile(filename,mode='w'):
+    """
+    context manager giving a file object opened with mode to write
+    filename. the file only replaces filename when the block finishes,
+    if the block fails the partly written file is removed
+    """
+    tmpfile = tmpName(filename)
+    try:
+        with open(tmpfile,mode) as f:
+            yield f
+        os.replace(tmpfile,filename)
+    except BaseException:
+        try:
+            os.remove(tmpfile)
+        except OSError:
+            pass
+        raise
+
+def writeAtomic(filename,data):
+    """ write the str or bytes data to filename """
+    mode = 'wb' if isinstance(data,bytes) else 'w'
+    with atomicFile(filename,mode) as f:
+        f.write(data)
@@ -0,0 +1,328 @@
+"""
+benchmark.py
+
+offline benchmarks of the search steps, to tell whether a change makes
+runs slower. nothing is downloaded, the images are synthetic and the
+tweets and known face galleries are generated.
+
+the steps are timed separately:
+
+  startup    - building a Searcher from a known face gallery, with every
+               encoding already in the photo cache
+  match      - matching detected faces against the gallery
+  decode     - decoding jpeg bytes at detection resolution
+  locations  - the face detector on the detection size image
+  detect     - detectFaces, scaling and detection together
+  encodings  - encoding a number of faces in an image
+  text       - building the keyword matcher and searching tweets
+  imports    - starting a fresh python process that imports photomongo
+               or runs a text only search, with the slow modules that
+               were imported, so text only runs stay fast to start
+
+synthetic images hold no real faces, so detection is timed on images
+where nothing is found and encoding on fixed boxes. --photos adds the
+photos in a directory to the decode, detect and encoding benchmarks with
+the number of faces actually found in each.
+
+results are written as json, one entry per step and parameters with the
+best, median and mean seconds of the repeats, so runs can be compared.
+
+Usage:
+  benchmark.py [options]
+
+Options:
+  -h --help              Show this screen.
+  -o --output=<file>     Write the results to file instead of stdout.
+  --galleries=<n>        Comma separated known gallery sizes [default: 10,100,1000,10000,100000].
+  --sizes=<px>           Comma separated image long edges [default: 320,640,1024,2048,4096].
+  --faces=<n>            Comma separated faces per image to encode [default: 1,4,16].
+  --keywords=<n>         Comma separated search keyword counts [default: 10,100,1000,10000].
+  --tweets=<n>           Number of generated tweets to search [default: 1000].
+  --photos=<dir>         Also benchmark the photos in dir.
+  --detector=<name>      Face detector, hog, cnn or cascade [default: hog].
+  --repeat=<n>           Number of timed runs of each step [default: 5].
+  --seed=<n>             Random seed [default: 0].
+  --skip=<groups>        Comma separated groups to leave out, of startup,
+                         images, text and imports.
+"""
+import logging
+log = logging.getLogger(__name__)
+
+import os
+import sys
+import io
+import glob
+import json
+import time
+import random
+import platform
+import tempfile
+import statistics
+import subprocess
+
+from docopt import docopt
+import numpy as np
+from PIL import Image
+
+# the photomongo modules live one directory up
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PACKAGE_DIR)
+
+import searcher
+from facecache import FaceCache, ENCODING_SIZE
+
+# modules that are slow to import and should only be imported when needed
+SLOW_MODULES = ( 'face_recognition', 'dlib', 'PIL.Image', 'apiclient',
+                 'googleapiclient', 'oauth2client.client' )
+
+# code run in a fresh process for each startup benchmark
+STARTUPS = { 'import' : 'import photomongo',
+             'text search' : 'import searcher\n'
+                             's = searcher.TweetSearcher({ "text" : "cat dog" })\n'
+                             's.searchText("a cat")' }
+
+def timeRepeat(func,repeat):
+    """
+    call func once to warm up and then repeat times, returning a dict of
+    the timing statistics in seconds
+    """
+    func()
+    times = []
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+    return { 'repeat' : repeat,
+             'best' : min(times),
+             'median' : statistics.median(times),
+             'mean' : statistics.mean(times) }
+
+def syntheticImage(rng,long_edge):
+    """
+    return a 4:3 rgb image with smooth random content, which compresses
+    and decodes more like a photo than noise does
+    """
+    width = long_edge
+    height = long_edge * 3 // 4
+    coarse = rng.integers(0, 256, size=(height//32+1, width//32+1, 3), dtype=np.uint8)
+    im = Image.fromarray(coarse).resize((width,height), Image.BICUBIC)
+    return np.asarray(im)
+
+def jpegBytes(im,quality=85):
+    """ return the rgb numpy array im encoded as jpeg """
+    buf = io.BytesIO()
+    Image.fromarray(im).save(buf, format='JPEG', quality=quality)
+    return buf.getvalue()
+
+def faceBoxes(width,height,n):
+    """ return n (top, right, bottom, left) boxes on a grid over the image """
+    side = int(np.ceil(np.sqrt(n)))
+    size = min(width,height) // side
+    boxes = []
+    for i in range(n):
+        row, col = divmod(i,side)
+        top = row*size
+        left = col*size
+        boxes.append( (top, left+size-1, top+size-1, left) )
+    return boxes
+
+def randomEncodings(rng,n):
+    """ return n random encodings with roughly the spread of real ones """
+    return rng.normal(0.0, 0.09, size=(n,ENCODING_SIZE))
+
+def makeGallery(rng,directory,n):
+    """
+    create a gallery of n placeholder known photos in directory and a
+    photo cache holding an encoding for each, return the gallery and the
+    cache file
+    """
+    gallery = os.path.join(directory, 'gallery')
+    os.mkdir(gallery)
+    cache_file = gallery + '.encodings.npz'
+    cache = FaceCache(cache_file)
+    encodings = randomEncodings(rng,n)
+    for i in range(n):
+        path = os.path.join(gallery, 'face%06d.jpg' % i)
+        with open(path,'wb') as f:
+            f.write(b'%d' % i)
+        cache.store(path, 'face%06d' % i, encodings[i])
+    cache.save()
+    return gallery, cache_file
+
+class Benchmark(object):
+    """
+    class to run the benchmarks and collect their results
+    """
+
+    repeat = 5
+    detector = 'hog'
+
+    def __init__(self,repeat=None,detector=None,seed=0):
+        if repeat is not None:
+            self.repeat = repeat
+        if detector is not None:
+            self.detector = detector
+        self.rng = np.random.default_rng(seed)
+        self.seed = seed
+        self.results = []
+        self.searcher = searcher.Searcher({ 'detector' : self.detector })
+
+    def run(self,step,func,**params):
+        """ time func and record it under step with params """
+        timing = timeRepeat(func,self.repeat)
+        entry = { 'step' : step, 'params' : params }
+        entry.update(timing)
+        self.results.append(entry)
+        log.info(step + ' ' + json.dumps(params) + ' best %.6f s' % timing['best'])
+        return entry
+
+    def benchStartup(self,galleries,unknown=(1,10,100)):
+        """ time building a searcher from a cached gallery and matching """
+        for n in galleries:
+            with tempfile.TemporaryDirectory() as directory:
+                gallery, cache_file = makeGallery(self.rng,directory,n)
+                conf = { 'photo' : gallery,
+                         'photo cache' : cache_file,
+                         'detector' : self.detector }
+                self.run('startup', lambda: searcher.Searcher(conf), gallery=n)
+
+                s = searcher.Searcher(conf)
+                for k in unknown:
+                    encodings = randomEncodings(self.rng,k)
+                    self.run('match', lambda: s.matchFaces(encodings),
+                             gallery=n, faces=k)
+
+    def benchImage(self,im,data,faces,**params):
+        """ time decoding, detection and encoding of one image """
+        s = self.searcher
+        height,width = im.shape[:2]
+        long_edge = s.detectLongEdge(width,height)
+
+        self.run('decode', lambda: searcher.decodeImage(data), scaled=False, **params)
+        self.run('decode', lambda: searcher.decodeImage(data, long_edge=long_edge),
+                 scaled=True, **params)
+
+        small = searcher.resizeImage(im, s.detectScale(width,height))
+        self.run('locations', lambda: s._faceLocations(small),
+                 detector=self.detector, **params)
+        self.run('detect', lambda: s.detectFaces(im),
+                 detector=self.detector, **params)
+
+        for n in faces:
+            boxes = faceBoxes(width,height,n)
+            self.run('encodings', lambda: s.encodeFaces(im,boxes),
+                     faces=n, **params)
+
+    def benchSynthetic(self,sizes,faces):
+        """ time the image steps on synthetic images of each long edge """
+        for long_edge in sizes:
+            im = syntheticImage(self.rng,long_edge)
+            self.benchImage(im, jpegBytes(im), faces, size=long_edge)
+
+    def benchPhotos(self,directory):
+        """ time the image steps on real photos with the faces found in them """
+        for path in sorted(glob.glob(os.path.join(directory,'*'))):
+            try:
+                with open(path,'rb') as f:
+                    data = f.read()
+                im, size = searcher.decodeImage(data)
+            except OSError:
+                continue
+            found = len(self.searcher.detectFaces(im))
+            self.benchImage(im, data, [found] if found else [],
+                            photo=os.path.basename(path),
+                            size=max(size), found=found)
+
+    def generateTweets(self,vocabulary,n):
+        """ return n generated tweet json dicts with text from vocabulary """
+        rnd = random.Random(self.seed)
+        tweets = []
+        for i in range(n):
+            words = rnd.choices(vocabulary, k=rnd.randint(5,50))
+            tweets.append({ 'id' : i,
+                            'id_str' : str(i),
+                            'full_text' : ' '.join(words),
+                            'user' : { 'screen_name' : 'feed%d' % (i % 20) },
+                            'entities' : {} })
+        return tweets
+
+    def benchText(self,keywords,ntweets):
+        """ time building the text search and searching generated tweets """
+        rnd = random.Random(self.seed)
+        vocabulary = [ ''.join(rnd.choices('abcdefghijklmnopqrstuvwxyz',
+                                           k=rnd.randint(3,10)))
+                       for i in range(20000) ]
+        texts = [ t['full_text'] for t in self.generateTweets(vocabulary,ntweets) ]
+
+        for k in keywords:
+            words = rnd.sample(vocabulary, k)
+            # a few phrases as well as single words
+            phrases = [ '"' + w + ' ' + rnd.choice(vocabulary) + '"'
+                        for w in words[:k//10] ]
+            conf = { 'text' : ' '.join(words[k//10:] + phrases) }
+            self.run('text init', lambda: searcher.Searcher(conf), keywords=k)
+
+            s = searcher.Searcher(conf)
+            def search():
+                for text in texts:
+                    s.searchText(text)
+            self.run('text', search, keywords=k, tweets=ntweets)
+
+    def benchImports(self):
+        """ time starting a process for each of the STARTUPS """
+        with tempfile.TemporaryDirectory() as directory:
+            for name,code in sorted(STARTUPS.items()):
+                script = 'import sys, json\n' +\
+                         'sys.path.insert(0, ' + repr(PACKAGE_DIR) + ')\n' +\
+                         code + '\n' +\
+                         'print(json.dumps([ m for m in ' + repr(SLOW_MODULES) +\
+                         ' if m in sys.modules ]))\n'
+                # photomongo logs to the current directory
+                run = lambda: subprocess.run( [ sys.executable, '-c', script ],
+                                              cwd = directory,
+                                              stdout = subprocess.PIPE,
+                                              check = True )
+                slow = json.loads(run().stdout.decode())
+                self.run('imports', run, scenario=name, slow_modules=slow)
+
+    def summary(self,args):
+        """ return the results with a description of the run """
+        return { 'created' : time.time(),
+                 'python' : platform.python_version(),
+                 'platform' : platform.platform(),
+                 'numpy' : np.__version__,
+                 'options' : args,
+                 'results' : self.results }
+
+def _ints(s):
+    return [ int(x) for x in s.split(',') if x.strip() ]
+
+if __name__=='__main__':
+
+    args = docopt(__doc__)
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+
+    skip = set(args['--skip'].split(',')) if args['--skip'] else set()
+
+    bench = Benchmark( repeat = int(args['--repeat']),
+                       detector = args['--detector'],
+                       seed = int(args['--seed']) )
+
+    if 'startup' not in skip:
+        bench.benchStartup(_ints(args['--galleries']))
+    if 'images' not in skip:
+        bench.benchSynthetic(_ints(args['--sizes']), _ints(args['--faces']))
+        if args['--photos']:
+            bench.benchPhotos(args['--photos'])
+    if 'text' not in skip:
+        bench.benchText(_ints(args['--keywords']), int(args['--tweets']))
+    if 'imports' not in skip:
+        bench.benchImports()
+
+    summary = bench.summary(args)
+    if args['--output']:
+        with open(args['--output'],'w') as f:
+            json.dump(summary, f, indent=2)
+    else:
+        json.dump(summary, sys.stdout, indent=2)
+        sys.stdout.write('\n')
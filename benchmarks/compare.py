@@ -0,0 +1,43 @@
+"""
+compare.py
+
+compare two benchmark.py result files and print the change in the best
+time of each step that is in both
+
+Usage:
+  compare.py [options] <before> <after>
+
+Options:
+  -h --help              Show this screen.
+  --threshold=<pct>      Only show changes of at least this percent [default: 0].
+"""
+import json
+
+from docopt import docopt
+
+def _key(entry):
+    return entry['step'] + ' ' + json.dumps(entry['params'], sort_keys=True)
+
+def loadResults(filename):
+    """ return a dict of step and params -> result entry """
+    with open(filename) as f:
+        summary = json.load(f)
+    return dict( ( _key(entry), entry ) for entry in summary['results'] )
+
+if __name__=='__main__':
+
+    args = docopt(__doc__)
+    threshold = float(args['--threshold'])
+
+    before = loadResults(args['<before>'])
+    after = loadResults(args['<after>'])
+
+    for key,entry in after.items():
+        if key not in before:
+            continue
+        old = before[key]['best']
+        new = entry['best']
+        change = 100.0 * (new - old) / old if old > 0 else 0.0
+        if abs(change) < threshold:
+            continue
+        print('%-60s %10.6f %10.6f %+7.1f%%' % (key, old, new, change))
@@ -0,0 +1,112 @@
+"""
+downloader.py
+
+download tweet media over a shared, pooled http session. media for
+upcoming tweets can be prefetched on a bounded thread pool while the
+current tweet is being searched.
+"""
+import logging
+log = logging.getLogger(__name__)
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+class DownloaderError(Exception):
+    pass
+
+class MediaDownloader(object):
+    """
+    class to download media urls, optionally ahead of time
+    """
+
+    threads = 4 # number of concurrent downloads
+    timeout = 10.0 # seconds for connect and for each read
+    retries = 3 # retries on connection errors and 5xx/429 responses
+    max_pending = 64 # maximum number of prefetched, unclaimed downloads
+
+    session = None
+    executor = None
+
+    pending = None # dict of url -> future
+
+    def __init__(self,
+                 threads = None,
+                 timeout = None,
+                 retries = None,
+                 max_pending = None):
+
+        if threads is not None:
+            self.threads = threads
+        if timeout is not None:
+            self.timeout = timeout
+        if retries is not None:
+            self.retries = retries
+        if max_pending is not None:
+            self.max_pending = max_pending
+
+        # one session with a connection pool big enough for all the threads
+        retry = Retry( total = self.retries,
+                       backoff_factor = 0.5,
+                       status_forcelist = (429, 500, 502, 503, 504) )
+        adapter = HTTPAdapter( pool_connections = self.threads,
+                               pool_maxsize = self.threads,
+                               max_retries = retry )
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self.executor = ThreadPoolExecutor( max_workers = self.threads )
+        self.pending = dict()
+        self._lock = threading.Lock()
+
+    def _fetch(self,url):
+        """ download url and return the content bytes """
+        log.debug('downloading ' + url)
+        try:
+            r = self.session.get(url, timeout = self.timeout)
+            r.raise_for_status()
+        except requests.RequestException as e:
+            raise DownloaderError('Could not download ' + url + ': ' + str(e))
+        return r.content
+
+    def prefetch(self,urls):
+        """
+        start downloading urls in the background, to be claimed later with
+        get. urls already pending are ignored and no more than max_pending
+        downloads are held at once.
+        """
+        with self._lock:
+            for url in urls:
+                if url in self.pending:
+                    continue
+                if len(self.pending) >= self.max_pending:
+                    log.debug('prefetch queue full, not prefetching ' + url)
+                    break
+                self.pending[url] = self.executor.submit(self._fetch, url)
+
+    def get(self,url):
+        """
+        return the content of url, waiting on a prefetched download if
+        there is one, otherwise downloading it now
+
+        raises DownloaderError if the download fails
+        """
+        with self._lock:
+            future = self.pending.pop(url, None)
+
+        if future is None:
+            return self._fetch(url)
+        return future.result()
+
+    def close(self):
+        """ cancel outstanding prefetches and release the connections """
+        with self._lock:
+            for future in self.pending.values():
+                future.cancel()
+            self.pending.clear()
+        self.executor.shutdown(wait = True)
+        self.session.close()
@@ -0,0 +1,182 @@
+"""
+facecache.py
+
+on-disk cache of known face encodings so that the reference photos do
+not have to be decoded and encoded on every run.
+
+entries are keyed by file path, file size, modification time and a hash
+of the file contents. if the size and mtime of a file are unchanged the
+cached encoding is used directly. if they changed, the file is hashed and
+the cached encoding is still used when the contents are the same (e.g.
+the file was only touched or copied). entries for files that no longer
+exist are dropped when the cache is saved.
+"""
+import logging
+log = logging.getLogger(__name__)
+
+import os
+import hashlib
+import numpy as np
+
+from atomicfile import atomicFile
+
+# length of a face_recognition encoding
+ENCODING_SIZE = 128
+
+def hashFile(filename, blocksize = 1 << 20):
+    """ return the sha1 hex digest of the contents of filename """
+    h = hashlib.sha1()
+    with open(filename,'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+class FaceCacheEntry(object):
+    """
+    class to hold one cached known face encoding
+    """
+
+    path = None
+    size = None
+    mtime = None
+    digest = None
+    name = None
+    encoding = None
+
+    def __init__(self,path,size,mtime,digest,name,encoding):
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        self.digest = digest
+        self.name = name
+        self.encoding = encoding
+
+class FaceCache(object):
+    """
+    class to load, query and save the known face encoding cache
+
+    the cache is stored as a numpy .npz file with one row per known photo
+    """
+
+    cache_file = None
+
+    entries = None # dict of path -> FaceCacheEntry
+    dirty = False # true if the cache needs to be written
+
+    def __init__(self,cache_file):
+        self.cache_file = cache_file
+        self.entries = dict()
+        self.load()
+
+    def load(self):
+        """ read the cache file if it exists, a bad file is ignored """
+
+        if not os.path.isfile(self.cache_file):
+            log.debug('No face cache at ' + self.cache_file)
+            return
+
+        try:
+            with np.load(self.cache_file) as data:
+                paths = data['paths']
+                sizes = data['sizes']
+                mtimes = data['mtimes']
+                digests = data['digests']
+                names = data['names']
+                encodings = data['encodings']
+        except (OSError, KeyError, ValueError):
+            log.warning('Could not read face cache ' + self.cache_file +\
+                        ', it will be rebuilt')
+            return
+
+        for i,path in enumerate(paths):
+            path = str(path)
+            self.entries[path] = FaceCacheEntry( path,
+                                                 int(sizes[i]),
+                                                 int(mtimes[i]),
+                                                 str(digests[i]),
+                                                 str(names[i]),
+                                                 encodings[i] )
+
+        log.debug('Loaded ' + str(len(self.entries)) + ' cached encodings')
+
+    def lookup(self,path):
+        """
+        return the cached encoding for path or None if there is no valid
+        cached encoding. a valid entry whose stat information was stale is
+        refreshed in place.
+        """
+
+        st = os.stat(path)
+        entry = self.entries.get(path)
+        if entry is None:
+            return None
+
+        if entry.size == st.st_size and entry.mtime == st.st_mtime_ns:
+            return entry.encoding
+
+        # size or time changed, see if the content actually changed
+        digest = hashFile(path)
+        if digest != entry.digest:
+            log.debug('Cached encoding for ' + path + ' is stale')
+            del self.entries[path]
+            self.dirty = True
+            return None
+
+        entry.size = st.st_size
+        entry.mtime = st.st_mtime_ns
+        self.dirty = True
+        return entry.encoding
+
+    def store(self,path,name,encoding):
+        """ add or replace the cached encoding for path """
+
+        st = os.stat(path)
+        self.entries[path] = FaceCacheEntry( path,
+                                             st.st_size,
+                                             st.st_mtime_ns,
+                                             hashFile(path),
+                                             name,
+                                             np.asarray(encoding) )
+        self.dirty = True
+
+    def prune(self,paths):
+        """ drop all entries whose path is not in paths """
+
+        keep = set(paths)
+        for path in list(self.entries):
+            if path not in keep:
+                log.debug('Dropping cached encoding for ' + path)
+                del self.entries[path]
+                self.dirty = True
+
+    def save(self):
+        """ write the cache file if anything changed """
+
+        if not self.dirty:
+            return
+
+        entries = list(self.entries.values())
+        if entries:
+            encodings = np.stack([ e.encoding for e in entries ])
+        else:
+            encodings = np.zeros((0,ENCODING_SIZE))
+
+        # an interrupted run does not leave a truncated cache behind
+        try:
+            with atomicFile(self.cache_file,'wb') as f:
+                np.savez( f,
+                          paths = np.array([ e.path for e in entries ], dtype=str),
+                          sizes = np.array([ e.size for e in entries ], dtype=np.int64),
+                          mtimes = np.array([ e.mtime for e in entries ], dtype=np.int64),
+                          digests = np.array([ e.digest for e in entries ], dtype=str),
+                          names = np.array([ e.name for e in entries ], dtype=str),
+                          encodings = encodings )
+        except OSError as e:
+            # e.g. a read-only photo directory, the search works without
+            # the cache, the known photos are just encoded every run
+            log.warning('Could not save the face cache ' + self.cache_file +\
+                        ': ' + str(e))
+            return
+
+        self.dirty = False
+        log.debug('Saved ' + str(len(entries)) + ' encodings to ' + self.cache_file)
@@ -12,19 +12,66 @@ https://console.developers.google.com
 import logging
 log = logging.getLogger(__name__)
 
-import httplib2
 import os
-
-from apiclient import discovery, errors
-from oauth2client import client
-from oauth2client import tools
-from oauth2client.file import Storage
+import time
+import hashlib
+
+# the google client libraries are slow to import, so they are only
+# imported when the first message is sent
+from lazy import LazyModule
+httplib2 = LazyModule('httplib2')
+discovery = LazyModule('apiclient.discovery')
+errors = LazyModule('apiclient.errors')
+client = LazyModule('oauth2client.client')
+tools = LazyModule('oauth2client.tools')
+oauth2file = LazyModule('oauth2client.file')
+
+import metrics
+from atomicfile import writeAtomic
 
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 import base64
 
 
+class DiscoveryCache(object):
+    """
+    class to keep the google api discovery documents in local files, so
+    the service object is built without fetching them every run
+
+    used as the cache of discovery.build, which calls get and set
+    """
+
+    cache_dir = None
+    max_age = 7*24*60*60 # seconds before a document is fetched again
+
+    def __init__(self,cache_dir,max_age=None):
+        self.cache_dir = cache_dir
+        if max_age is not None:
+            self.max_age = max_age
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _file(self,url):
+        return os.path.join(self.cache_dir,
+                            hashlib.sha1(url.encode('utf-8')).hexdigest() + '.json')
+
+    def get(self,url):
+        filename = self._file(url)
+        try:
+            if os.path.getmtime(filename) + self.max_age < time.time():
+                return None
+            with open(filename) as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def set(self,url,content):
+        filename = self._file(url)
+        try:
+            writeAtomic(filename,content)
+        except OSError:
+            log.warning('Could not cache discovery document in ' + filename)
+
 class Gmail(object):
     """
     class to handle connecting to gmail so that emails may be sent
@@ -42,6 +89,9 @@ class Gmail(object):
     # the google service object that will perform the work
     service = None
 
+    # directory to cache the api discovery document in, see DiscoveryCache
+    discovery_cache_dir = None
+
     def __init__(self,gmailconf):
         """
         gmailconf should be a dictionary-like object with required keys:
@@ -59,14 +109,29 @@ class Gmail(object):
             self.send_to = gmailconf['to email address']
             self.send_from = gmailconf['from email address']
 
+            try:
+                self.discovery_cache_dir = os.path.expanduser(
+                                               gmailconf['discovery cache dir'] )
+            except KeyError:
+                self.discovery_cache_dir = os.path.join(os.path.expanduser('~'),
+                                                        '.credentials',
+                                                        'discovery_cache')
+
+    def get_service(self):
+        """
+        return the gmail service object, connecting on the first call so
+        runs that send nothing do not pay for it
+        """
+        if self.service is None:
             # get the login credentials from storage, or generate them
             self.credentials = self.get_credentials()
 
             # create the service object
             http = self.credentials.authorize(httplib2.Http())
-            self.service = discovery.build('gmail', 'v1', http=http)
+            self.service = discovery.build('gmail', 'v1', http=http,
+                                           cache = DiscoveryCache(self.discovery_cache_dir))
+        return self.service
 
-    
 
     def get_credentials(self):
         """Gets valid user credentials from storage.
@@ -84,7 +149,7 @@ class Gmail(object):
         credential_path = os.path.join(credential_dir,
                                        self.credential_file)
 
-        store = Storage(credential_path)
+        store = oauth2file.Storage(credential_path)
         credentials = store.get()
         if not credentials or credentials.invalid:
             flow = client.flow_from_clientsecrets(self.client_secret_file, self.scopes)
@@ -137,21 +202,24 @@ class Gmail(object):
       Returns:
         Sent Message.
       """
-      service = self.service
+      service = self.get_service()
       user_id = 'me'
       
       try:
-        message = (service.users().messages().send(userId=user_id, body=message)
-                   .execute())
+        with metrics.timer('gmail_send'):
+          message = (service.users().messages().send(userId=user_id, body=message)
+                     .execute())
+        metrics.count('emails_sent')
         log.debug('Message Id: ' + message['id'])
         return message
       except errors.HttpError:
+        metrics.count('email_errors')
         log.error('An error occurred')
         raise
 
     def create_and_send_message(self,subject,message_text):
         """ combine create and send message methods """
-        if self.service is None:
+        if self.send_to is None:
             # not configured, don't do anything, jut reutn
             return
         
@@ -0,0 +1,39 @@
+"""
+lazy.py
+
+stand-ins for modules that are slow to import, e.g. face_recognition which
+loads dlib and its models, so that runs that never use them, like a text
+only search, do not pay for importing them. the module is imported the
+first time one of its attributes is used.
+"""
+import logging
+log = logging.getLogger(__name__)
+
+import importlib
+
+class LazyModule(object):
+    """
+    class to stand in for the module name until it is first used
+    """
+
+    def __init__(self,name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        module = self.__dict__['_module']
+        if module is None:
+            log.debug('Importing ' + self._name)
+            module = importlib.import_module(self._name)
+            self.__dict__['_module'] = module
+        return module
+
+    def loaded(self):
+        """ return True if the module was imported """
+        return self.__dict__['_module'] is not None
+
+    def __getattr__(self,attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        return '<lazy module ' + self._name + '>'
@@ -0,0 +1,182 @@
+"""
+ledger.py
+
+sqlite ledger of the tweets and media that have already been searched,
+along with the results for each media item and each perceptual image
+hash, so that re-runs over overlapping time frames, retweets and quote
+tweets skip work that was already done.
+"""
+import logging
+log = logging.getLogger(__name__)
+
+import sqlite3
+import time
+import json
+import hashlib
+import threading
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tweets (
+    id_str TEXT PRIMARY KEY,
+    processed REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS media (
+    url TEXT PRIMARY KEY,
+    digest TEXT,
+    processed REAL NOT NULL,
+    results TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS images (
+    hash TEXT PRIMARY KEY,
+    width INTEGER NOT NULL,
+    height INTEGER NOT NULL,
+    processed REAL NOT NULL,
+    results TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS media_digest ON media (digest);
+CREATE INDEX IF NOT EXISTS tweets_processed ON tweets (processed);
+CREATE INDEX IF NOT EXISTS media_processed ON media (processed);
+CREATE INDEX IF NOT EXISTS images_processed ON images (processed);
+"""
+
+# hex digits of a 256 bit perceptual hash. images recorded with the
+# older 64 bit hash too often matched different faces in the same scene,
+# so they are removed when the ledger is opened
+_IMAGE_HASH_DIGITS = 64
+
+def digestBytes(data):
+    """ return the sha1 hex digest of data """
+    return hashlib.sha1(data).hexdigest()
+
+class Ledger(object):
+    """
+    class to record and look up processed tweets and media
+
+    media results are stored as a list of [match_name, match_loc, distance]
+    """
+
+    ledger_file = None
+    retention_days = 30 # entries older than this are removed by compact
+
+    conn = None
+
+    def __init__(self,ledger_file,retention_days=None):
+
+        self.ledger_file = ledger_file
+        if retention_days is not None:
+            self.retention_days = retention_days
+
+        # several worker processes may share the ledger, so wait on locks.
+        # the pipeline stages also share the connection between threads,
+        # so all access goes through self.lock
+        self.conn = sqlite3.connect(ledger_file,
+                                    timeout = 60,
+                                    check_same_thread = False)
+        self.lock = threading.RLock()
+        self.conn.executescript(_SCHEMA)
+        self.conn.execute('DELETE FROM images WHERE length(hash) != ?',
+                          (_IMAGE_HASH_DIGITS,))
+        self.conn.commit()
+
+    @classmethod
+    def fromConfig(cls,searchconfig):
+        """
+        return a Ledger for the 'ledger file' in searchconfig or None if it
+        is not configured
+        """
+        try:
+            ledger_file = searchconfig['ledger file']
+        except KeyError:
+            return None
+
+        try:
+            retention_days = float(searchconfig['ledger retention days'])
+        except KeyError:
+            retention_days = None
+
+        return cls(ledger_file, retention_days = retention_days)
+
+    def _query(self,sql,args=()):
+        """ run a select and return all the rows """
+        with self.lock:
+            return self.conn.execute(sql,args).fetchall()
+
+    def _write(self,sql,args=()):
+        """ run an insert or delete and commit it """
+        with self.lock:
+            self.conn.execute(sql,args)
+            self.conn.commit()
+
+    def hasTweet(self,id_str):
+        """ return True if the tweet was already searched """
+        return len(self._query('SELECT 1 FROM tweets WHERE id_str = ?',
+                               (id_str,))) > 0
+
+    def addTweet(self,id_str):
+        """ record that the tweet was searched """
+        self._write('INSERT OR REPLACE INTO tweets VALUES (?, ?)',
+                    (id_str, time.time()))
+
+    def _results(self,rows):
+        if not rows:
+            return None
+        return json.loads(rows[0][0])
+
+    def mediaResults(self,url):
+        """ return the stored results for a media url or None """
+        return self._results(self._query('SELECT results FROM media'
+                                         ' WHERE url = ?', (url,)))
+
+    def digestResults(self,digest):
+        """ return the stored results for media content or None """
+        return self._results(self._query('SELECT results FROM media'
+                                         ' WHERE digest = ? LIMIT 1', (digest,)))
+
+    def addMedia(self,url,digest,results):
+        """ record the results of searching the media at url """
+        self._write('INSERT OR REPLACE INTO media VALUES (?, ?, ?, ?)',
+                    (url, digest, time.time(), json.dumps(results)))
+
+    def addImage(self,h,size,results):
+        """
+        record the results found in an image with perceptual hash h and
+        (width, height) size. nothing is recorded for an image too small
+        to hash, with h None
+        """
+        if h is None:
+            return
+        # hashes are too big for a sqlite integer
+        self._write('INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?)',
+                    ('%0*x' % (_IMAGE_HASH_DIGITS,h), size[0], size[1], time.time(),
+                     json.dumps(results)))
+
+    def images(self):
+        """
+        generator yielding (hash, size, results, processed) for all the
+        recorded images
+        """
+        rows = self._query('SELECT hash, width, height, results, processed'
+                           ' FROM images')
+        for h,width,height,results,processed in rows:
+            yield int(h,16), (width,height), json.loads(results), processed
+
+    def compact(self):
+        """
+        remove entries older than retention_days and reclaim the space
+        """
+        cutoff = time.time() - self.retention_days * 24 * 60 * 60
+        with self.lock:
+            with self.conn:
+                ntweets = self.conn.execute('DELETE FROM tweets WHERE processed < ?',
+                                            (cutoff,)).rowcount
+                nmedia = self.conn.execute('DELETE FROM media WHERE processed < ?',
+                                           (cutoff,)).rowcount
+                self.conn.execute('DELETE FROM images WHERE processed < ?',
+                                  (cutoff,))
+            log.debug('Removed ' + str(ntweets) + ' tweets and ' + str(nmedia) +\
+                      ' media from ledger')
+            self.conn.execute('VACUUM')
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
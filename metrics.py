@@ -0,0 +1,261 @@
+"""
+metrics.py
+
+timings and counts of the work done in a run, so it can be seen where
+the time of a run went. stages are timed into latency histograms and
+events are counted, e.g.
+
+    with metrics.timer('download'):
+        data = get(url)
+    metrics.count('download_bytes', len(data))
+
+at the end of a run the metrics are written as a json summary and as a
+prometheus textfile for the node exporter textfile collector, as set in
+the [metrics] section of the configuration.
+
+each process has its own registry. worker processes send a snapshot of
+theirs back with their results to be merged into the main one.
+"""
+import logging
+log = logging.getLogger(__name__)
+
+import json
+import time
+import threading
+import contextlib
+
+from atomicfile import writeAtomic
+
+# upper bounds in seconds of the latency histogram buckets
+BUCKETS = ( 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+            1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0 )
+
+# prefix of the prometheus metric names
+PREFIX = 'photomongo_'
+
+class Histogram(object):
+    """
+    class to hold the distribution of the latencies of one stage
+    """
+
+    count = 0
+    total = 0.0 # sum of all the observed values
+    low = None # smallest observed value
+    high = None # largest observed value
+    buckets = None # number of values in each bucket, the last is +Inf
+
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def observe(self,value):
+        self.count += 1
+        self.total += value
+        if self.low is None or value < self.low:
+            self.low = value
+        if self.high is None or value > self.high:
+            self.high = value
+        for i,bound in enumerate(BUCKETS):
+            if value <= bound:
+                break
+        else:
+            i = len(BUCKETS)
+        self.buckets[i] += 1
+
+    def merge(self,other):
+        """ add the observations of other, a Histogram or its dict """
+        if isinstance(other,dict):
+            other = Histogram.fromDict(other)
+        self.count += other.count
+        self.total += other.total
+        for value in (other.low, other.high):
+            if value is None:
+                continue
+            if self.low is None or value < self.low:
+                self.low = value
+            if self.high is None or value > self.high:
+                self.high = value
+        self.buckets = [ a+b for a,b in zip(self.buckets,other.buckets) ]
+
+    def quantile(self,q):
+        """ estimate the q quantile from the buckets """
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i,n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                return min(BUCKETS[i], self.high) if i < len(BUCKETS) else self.high
+        return self.high
+
+    def toDict(self):
+        return { 'count' : self.count,
+                 'sum' : self.total,
+                 'min' : self.low,
+                 'max' : self.high,
+                 'buckets' : list(self.buckets) }
+
+    @classmethod
+    def fromDict(cls,d):
+        h = cls()
+        h.count = d['count']
+        h.total = d['sum']
+        h.low = d['min']
+        h.high = d['max']
+        h.buckets = list(d['buckets'])
+        return h
+
+class Metrics(object):
+    """
+    class to collect the counters, gauges and stage histograms of a run
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.counters = dict()
+            self.gauges = dict()
+            self.histograms = dict()
+
+    def count(self,name,n=1):
+        """ add n to the counter name """
+        with self.lock:
+            self.counters[name] = self.counters.get(name,0) + n
+
+    def gauge(self,name,value):
+        """ set the gauge name to value """
+        with self.lock:
+            self.gauges[name] = value
+
+    def observe(self,stage,seconds):
+        """ record that stage took seconds """
+        with self.lock:
+            h = self.histograms.get(stage)
+            if h is None:
+                h = self.histograms[stage] = Histogram()
+            h.observe(seconds)
+
+    @contextlib.contextmanager
+    def timer(self,stage):
+        """ context manager that times its body as one run of stage """
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - t0)
+
+    def drain(self):
+        """
+        return the counters and histograms as a picklable snapshot and
+        clear them, so a worker sends each observation back only once
+        """
+        with self.lock:
+            snap = { 'counters' : self.counters,
+                     'histograms' : { k : h.toDict()
+                                      for k,h in self.histograms.items() } }
+            self.counters = dict()
+            self.histograms = dict()
+        return snap
+
+    def merge(self,snap):
+        """ add a snapshot from another process """
+        with self.lock:
+            for name,n in snap['counters'].items():
+                self.counters[name] = self.counters.get(name,0) + n
+            for stage,d in snap['histograms'].items():
+                h = self.histograms.get(stage)
+                if h is None:
+                    h = self.histograms[stage] = Histogram()
+                h.merge(d)
+
+    def summary(self):
+        """ return a json-able summary of the run """
+        with self.lock:
+            stages = dict()
+            for stage,h in sorted(self.histograms.items()):
+                stages[stage] = { 'count' : h.count,
+                                  'total' : h.total,
+                                  'mean' : h.total / h.count if h.count else None,
+                                  'min' : h.low,
+                                  'max' : h.high,
+                                  'p50' : h.quantile(0.5),
+                                  'p90' : h.quantile(0.9),
+                                  'p99' : h.quantile(0.99) }
+            return { 'started' : self.started,
+                     'finished' : time.time(),
+                     'counters' : dict(sorted(self.counters.items())),
+                     'gauges' : dict(sorted(self.gauges.items())),
+                     'stages' : stages }
+
+    def prometheus(self):
+        """ return the metrics in the prometheus text exposition format """
+        lines = []
+        with self.lock:
+            for name,n in sorted(self.counters.items()):
+                metric = PREFIX + name + '_total'
+                lines.append('# TYPE ' + metric + ' counter')
+                lines.append(metric + ' ' + repr(n))
+
+            for name,value in sorted(self.gauges.items()):
+                metric = PREFIX + name
+                lines.append('# TYPE ' + metric + ' gauge')
+                lines.append(metric + ' ' + repr(value))
+
+            if self.histograms:
+                metric = PREFIX + 'stage_seconds'
+                lines.append('# HELP ' + metric + ' time spent in each stage of a run')
+                lines.append('# TYPE ' + metric + ' histogram')
+            for stage,h in sorted(self.histograms.items()):
+                label = 'stage="' + stage + '"'
+                cumulative = 0
+                for bound,n in zip(BUCKETS + ('+Inf',), h.buckets):
+                    cumulative += n
+                    lines.append(metric + '_bucket{' + label + ',le="' +\
+                                 str(bound) + '"} ' + str(cumulative))
+                lines.append(metric + '_sum{' + label + '} ' + repr(h.total))
+                lines.append(metric + '_count{' + label + '} ' + str(h.count))
+
+            metric = PREFIX + 'last_run_timestamp_seconds'
+            lines.append('# TYPE ' + metric + ' gauge')
+            lines.append(metric + ' ' + repr(time.time()))
+
+        return '\n'.join(lines) + '\n'
+
+# the metrics of this process
+registry = Metrics()
+
+count = registry.count
+gauge = registry.gauge
+observe = registry.observe
+timer = registry.timer
+
+def writeMetrics(metricsconf,metrics=None):
+    """
+    write the 'json file' and 'prometheus file' set in metricsconf, which
+    may be None when metrics are not configured
+    """
+    if metricsconf is None:
+        return
+    if metrics is None:
+        metrics = registry
+
+    try:
+        json_file = metricsconf['json file']
+    except KeyError:
+        json_file = None
+    try:
+        prometheus_file = metricsconf['prometheus file']
+    except KeyError:
+        prometheus_file = None
+
+    if json_file:
+        writeAtomic(json_file, json.dumps(metrics.summary(), indent=2) + '\n')
+        log.info('Wrote metrics summary to ' + json_file)
+    if prometheus_file:
+        # the textfile collector may read at any time
+        writeAtomic(prometheus_file, metrics.prometheus())
+        log.info('Wrote prometheus metrics to ' + prometheus_file)
@@ -0,0 +1,262 @@
+"""
+outbox.py
+
+notifications waiting to be emailed, kept in a local spool directory and
+sent by a background thread so searching does not wait on gmail.
+
+search results are collected into digest messages, each capped by the
+number of results and size, and sent once enough results are waiting or
+the oldest has waited the digest delay. a failed send is tried again
+with exponential backoff. spooled notifications that could not be sent
+before exit are sent on the next run.
+"""
+import logging
+log = logging.getLogger(__name__)
+
+import os
+import json
+import time
+import itertools
+import threading
+
+import metrics
+from atomicfile import atomicFile
+
+# kinds of spooled notifications
+RESULT = 'result' # one search result line, sent in a digest
+MESSAGE = 'message' # a message sent on its own
+
+class Outbox(object):
+    """
+    class to spool notifications and send them with a Gmail in the
+    background
+    """
+
+    spool_dir = 'photomongo_spool'
+    digest_max_results = 50 # results per digest message
+    digest_max_bytes = 100000 # size of the text of a digest message
+    digest_delay = 60.0 # seconds a result may wait for more to join it
+    retry_base = 30.0 # seconds to wait after the first failed send
+    retry_max = 3600.0 # longest wait between tries
+    flush_timeout = 300.0 # seconds close waits for the spool to empty
+    stop_timeout = 10.0 # seconds close then waits for a send in progress
+
+    gm = None
+    enabled = False
+
+    def __init__(self,gm,gmailconf=None):
+        self.gm = gm
+        # nothing is spooled when gmail is not configured
+        self.enabled = gm is not None and gm.send_to is not None
+
+        if gmailconf is None:
+            gmailconf = dict()
+        try:
+            self.spool_dir = gmailconf['spool dir']
+        except KeyError:
+            pass
+        for key,attr in ( ('digest max results', 'digest_max_results'),
+                          ('digest max bytes', 'digest_max_bytes') ):
+            try:
+                setattr(self, attr, int(gmailconf[key]))
+            except KeyError:
+                pass
+        for key,attr in ( ('digest delay', 'digest_delay'),
+                          ('retry base', 'retry_base'),
+                          ('retry max', 'retry_max'),
+                          ('flush timeout', 'flush_timeout') ):
+            try:
+                setattr(self, attr, float(gmailconf[key]))
+            except KeyError:
+                pass
+
+        self._cond = threading.Condition()
+        self._seq = itertools.count()
+        self._pending = [] # (spool file, notification) in spool order
+        self._failures = 0
+        self._retry_at = 0.0 # no sends before this time
+        self._flushing = False
+        self._stop = False
+        self._thread = None
+
+        if self.enabled:
+            os.makedirs(self.spool_dir, exist_ok=True)
+
+    def _loadSpool(self):
+        """
+        pick up notifications left in the spool by an earlier run or an
+        earlier outbox
+        """
+        found = []
+        with self._cond:
+            spooled = set( f for f,n in self._pending )
+        for name in sorted(os.listdir(self.spool_dir)):
+            if not name.endswith('.json'):
+                continue
+            filename = os.path.join(self.spool_dir, name)
+            if filename in spooled:
+                continue
+            try:
+                with open(filename) as f:
+                    found.append( (filename, json.load(f)) )
+            except ( OSError, ValueError ):
+                log.warning('Dropping unreadable spooled notification ' + filename)
+                os.remove(filename)
+        if found:
+            log.info('Found ' + str(len(found)) +\
+                     ' spooled notifications to send')
+        with self._cond:
+            # names sort in the order the notifications were added
+            self._pending = sorted( self._pending + found,
+                                    key = lambda p: os.path.basename(p[0]) )
+
+    def _spool(self,notification):
+        # names sort in the order the notifications were added
+        name = '%.6f-%d-%d.json' % (time.time(), os.getpid(), next(self._seq))
+        filename = os.path.join(self.spool_dir, name)
+        with atomicFile(filename) as f:
+            json.dump(notification, f)
+
+        with self._cond:
+            self._pending.append( (filename, notification) )
+            self._cond.notify()
+
+    def addResults(self,results):
+        """ spool a list of TweetResults to be sent in a digest """
+        if not self.enabled:
+            return
+        for sr in results:
+            self._spool({ 'kind' : RESULT,
+                          'created' : time.time(),
+                          'text' : sr.url() + ' at ' + str(sr.match_loc) })
+
+    def addMessage(self,subject,text):
+        """ spool a message to be sent on its own """
+        if not self.enabled:
+            return
+        self._spool({ 'kind' : MESSAGE,
+                      'created' : time.time(),
+                      'subject' : subject,
+                      'text' : text })
+
+    def start(self):
+        """ start sending in the background """
+        if not self.enabled or self._thread is not None:
+            return
+        self._loadSpool()
+        self._thread = threading.Thread( target = self._run,
+                                         name = 'outbox',
+                                         daemon = True )
+        self._thread.start()
+
+    def _next(self):
+        """
+        return the spooled (filename, notification) pairs of the next
+        message to send, or the number of seconds until one is due
+        """
+        now = time.time()
+        if now < self._retry_at:
+            return self._retry_at - now
+        if not self._pending:
+            return None
+
+        for filename,notification in self._pending:
+            if notification['kind'] == MESSAGE:
+                return [ (filename,notification) ]
+
+        # collect results into a digest up to the caps
+        batch = []
+        size = 0
+        for filename,notification in self._pending:
+            size += len(notification['text']) + 2
+            if batch and ( len(batch) >= self.digest_max_results or
+                           size > self.digest_max_bytes ):
+                return batch
+            batch.append( (filename,notification) )
+
+        # not full yet, wait a while for more results to join it
+        oldest = min( n['created'] for f,n in batch )
+        wait = oldest + self.digest_delay - now
+        if wait > 0 and not self._flushing:
+            return wait
+        return batch
+
+    def _send(self,batch):
+        """ send one message made of the batch """
+        if batch[0][1]['kind'] == MESSAGE:
+            subject = batch[0][1]['subject']
+            text = batch[0][1]['text']
+        else:
+            subject = 'photomongo results to review'
+            if len(batch) > 1:
+                subject += ' (' + str(len(batch)) + ' results)'
+            text = '\n\n'.join([ n['text'] for f,n in batch ]) + '\n\n'
+
+        with metrics.timer('notify'):
+            self.gm.create_and_send_message(subject, text)
+        metrics.count('notifications_sent')
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._stop:
+                        return
+                    batch = self._next()
+                    if isinstance(batch,list):
+                        break
+                    self._cond.wait(batch)
+
+            try:
+                self._send(batch)
+            except Exception:
+                with self._cond:
+                    self._failures += 1
+                    delay = min( self.retry_max,
+                                 self.retry_base * 2**(self._failures-1) )
+                    self._retry_at = time.time() + delay
+                    self._cond.notify_all()
+                log.exception('Could not send notification, trying again in ' +\
+                              str(int(delay)) + ' seconds')
+                metrics.count('notification_errors')
+                continue
+
+            with self._cond:
+                self._failures = 0
+                sent = set( f for f,n in batch )
+                self._pending = [ p for p in self._pending if p[0] not in sent ]
+                self._cond.notify_all()
+            for filename in sent:
+                try:
+                    os.remove(filename)
+                except OSError:
+                    pass
+
+    def close(self):
+        """
+        send what is waiting, for up to flush_timeout seconds, and stop.
+        a failed send is not waited out, nor is a send stuck on the network
+        for more than stop_timeout. anything unsent stays in the spool for
+        the next run
+        """
+        if self._thread is None:
+            return
+        deadline = time.time() + self.flush_timeout
+        with self._cond:
+            self._flushing = True
+            self._retry_at = 0.0
+            failures = self._failures
+            self._cond.notify_all()
+            while self._pending and time.time() < deadline and \
+                  self._failures <= failures:
+                self._cond.wait(deadline - time.time())
+            if self._pending:
+                log.warning(str(len(self._pending)) + ' notifications left in ' +\
+                            self.spool_dir + ' to send on the next run')
+            self._stop = True
+            self._cond.notify_all()
+        self._thread.join(self.stop_timeout)
+        if self._thread.is_alive():
+            # the daemon thread is left to finish or die with the process
+            log.warning('Gave up waiting for a notification to be sent')
+        self._thread = None
@@ -0,0 +1,177 @@
+"""
+perceptual.py
+
+perceptual image hashing to find near-duplicate images, e.g. the same
+photo posted in several tweets or re-encoded at a different size, so that
+face detection only runs once per distinct image.
+"""
+import logging
+log = logging.getLogger(__name__)
+
+import threading
+import time
+import numpy as np
+
+# luma weights to convert rgb to grayscale
+_LUMA = np.array([0.299, 0.587, 0.114])
+
+def _binMeans(a,nbins,axis):
+    """ average a into nbins roughly equal bins along axis """
+    edges = np.linspace(0, a.shape[axis], nbins+1).astype(np.intp)[:-1]
+    sums = np.add.reduceat(a, edges, axis=axis, dtype=np.float64)
+    counts = np.diff(np.append(edges, a.shape[axis]))
+    shape = [1] * a.ndim
+    shape[axis] = nbins
+    return sums / counts.reshape(shape)
+
+# size of the grid of block averages that is hashed, 16 gives 256 bits
+# so that a different face in the same picture changes the hash
+HASH_SIZE = 16
+HASH_BYTES = HASH_SIZE * HASH_SIZE // 8
+
+def canHash(im):
+    """ return True if im is big enough to hash with dhash """
+    return im.shape[0] >= HASH_SIZE and im.shape[1] >= HASH_SIZE+1
+
+def dhash(im):
+    """
+    return the 256 bit difference hash of im as a python int
+
+    im is an (h x w x 3) rgb or (h x w) grayscale numpy array. the image is
+    reduced to a (16 x 17) grid of block averages and each bit records
+    whether a block is brighter than its right neighbor.
+    """
+    hash_size = HASH_SIZE
+    im = np.asarray(im)
+    if not canHash(im):
+        raise ValueError('image too small to hash')
+
+    # shrink first so the grayscale conversion only touches a few pixels
+    small = _binMeans(_binMeans(im, hash_size, 0), hash_size+1, 1)
+    if small.ndim == 3:
+        small = small[:,:,:3].dot(_LUMA)
+
+    bits = (small[:,1:] > small[:,:-1]).ravel()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+def rescaleLocation(loc,from_size,to_size):
+    """
+    map a (top, right, bottom, left) box from an image of from_size
+    (width, height) to an image of to_size
+    """
+    sx = to_size[0] / from_size[0]
+    sy = to_size[1] / from_size[1]
+    top,right,bottom,left = loc
+    return ( int(round(top*sy)), int(round(right*sx)),
+             int(round(bottom*sy)), int(round(left*sx)) )
+
+class HashIndex(object):
+    """
+    class to look up stored results by near-duplicate image hash
+
+    each entry holds a hash, the (width, height) of the hashed image and
+    the results found in it. entries older than retention seconds are
+    dropped when the index fills up, so a long running search does not
+    grow it forever. an entry only matches an image with the same
+    aspect ratio that is no bigger than the hashed image, since faces too
+    small to find in the hashed image may be found in a bigger copy
+    """
+
+    max_distance = 0 # maximum number of differing bits for a duplicate
+    max_aspect_difference = 0.02 # maximum relative difference of aspect ratio
+    min_size_ratio = 0.9 # smallest hashed image size relative to the image
+
+    retention = None # seconds entries are kept, forever if None
+
+    hashes = None # (n x HASH_BYTES) np.uint8 array, grown by doubling
+    sizes = None # (n x 2) float array of width, height
+    added = None # float array of the time each entry was added
+    results = None
+
+    def __init__(self,max_distance=None,retention=None):
+        if max_distance is not None:
+            self.max_distance = max_distance
+        if retention is not None:
+            self.retention = retention
+        self.hashes = np.zeros((64,HASH_BYTES), dtype=np.uint8)
+        self.sizes = np.zeros((64,2))
+        self.added = np.zeros(64)
+        self.results = []
+        # lookups and adds may come from different threads
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.results)
+
+    def _prune(self):
+        """ drop the entries older than retention, with the lock held """
+        if self.retention is None:
+            return
+        n = len(self.results)
+        keep = np.flatnonzero( self.added[:n] >= time.time() - self.retention )
+        m = len(keep)
+        if m == n:
+            return
+        self.hashes[:m] = self.hashes[keep]
+        self.sizes[:m] = self.sizes[keep]
+        self.added[:m] = self.added[keep]
+        self.results = [ self.results[i] for i in keep ]
+        log.debug('Removed ' + str(n-m) + ' image hashes from index')
+
+    def add(self,h,size,results,added=None):
+        """
+        add the results found in an image with hash h and size at time
+        added, now if None. an image too small to hash has h None and is
+        not added
+        """
+        if h is None:
+            return
+        if added is None:
+            added = time.time()
+        with self.lock:
+            n = len(self.results)
+            if n == len(self.hashes):
+                self._prune()
+                n = len(self.results)
+                # grow when pruning did not leave room for a while
+                if n >= len(self.hashes) * 3 // 4:
+                    self.hashes = np.concatenate([ self.hashes,
+                                                   np.zeros_like(self.hashes) ])
+                    self.sizes = np.concatenate([ self.sizes,
+                                                  np.zeros_like(self.sizes) ])
+                    self.added = np.concatenate([ self.added,
+                                                  np.zeros_like(self.added) ])
+            self.hashes[n] = np.frombuffer(h.to_bytes(HASH_BYTES,'big'),
+                                           dtype=np.uint8)
+            self.sizes[n] = size
+            self.added[n] = added
+            self.results.append(results)
+
+    def lookup(self,h,size):
+        """
+        return (size, results) of the closest stored image within
+        max_distance bits of h that can stand in for an image of size,
+        or None
+        """
+        with self.lock:
+            n = len(self.results)
+            if n == 0:
+                return None
+
+            # hamming distance to every stored hash at once
+            x = np.bitwise_xor(self.hashes[:n],
+                               np.frombuffer(h.to_bytes(HASH_BYTES,'big'),
+                                             dtype=np.uint8))
+            distance = np.unpackbits(x, axis=1).sum(axis=1)
+
+            # only images of the same shape and at least the same size
+            width, height = size
+            aspect = self.sizes[:n,0] / self.sizes[:n,1]
+            usable = ( np.abs(aspect*height/width - 1) <= self.max_aspect_difference ) &\
+                     ( self.sizes[:n,0] >= self.min_size_ratio*width )
+            distance[~usable] = HASH_BYTES*8 + 1
+
+            i = int(np.argmin(distance))
+            if distance[i] > self.max_distance:
+                return None
+            return tuple(int(v) for v in self.sizes[i]), self.results[i]
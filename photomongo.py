@@ -7,11 +7,20 @@ Usage:
 
 Options:
   -h --help                   Show this screen. 
-  --pickle-to=<picklefile>    file to save tweets.
-  --pickle-from=<picklefile>  file to read tweets.
+  --archive-to=<archive>      file to save tweets to as they are fetched.
+  --archive-from=<archive>    file to read saved tweets from.
+  --ids=<ids>                 comma separated tweet ids to read from the
+                              archive, all are read if not set
+  --pickle-from=<picklefile>  file to read tweets saved by older versions.
   --max=<number>              maximum number to process, primarily for debug
   --since=<days>              maximum number of days to get in the past
   --progress-bar              display the progress bar
+  --workers=<n>               number of processes to search tweets [default: 1]
+  --pipeline                  search in a pipeline of concurrent stages,
+                              configured in the [pipeline] section
+  --daemon                    keep running and search new tweets every poll
+                              interval of the [daemon] section. SIGHUP
+                              reloads CONFIGFILE
 
 """
 
@@ -31,12 +40,27 @@ import configparser
 import json
 
 import searcher
+import pipeline
+import metrics
+from ledger import Ledger
+from resultstore import ResultStore
 from twitter import Twitter
 from gmail import Gmail
+from outbox import Outbox
 import progress_bar
 
-# to save/reload tweets use pickle
+# to save/reload tweets use an archive, older versions used pickle
 import pickle
+from archive import ArchiveWriter, ArchiveReader
+
+import multiprocessing
+import multiprocessing.util
+import itertools
+import collections
+import datetime
+import time
+import signal
+import threading
 
 # control logging level of modules
 logging.getLogger("requests").setLevel(logging.WARNING)
@@ -47,54 +71,170 @@ logging.getLogger("tweepy").setLevel(logging.WARNING)
 logging.getLogger("requests_oauthlib").setLevel(logging.WARNING)
 logging.getLogger("googleapiclient").setLevel(logging.WARNING)
 
-if __name__=='__main__':
-    
-    args = docopt(__doc__)
+# each worker process builds its own searcher once, see _initWorker
+_worker_searcher = None
 
-    try:
-        pickleFromFile = args['--pickle-from']
-    except KeyError:
-        pickleFromFile = None
+def _initWorker(searchconf):
+    """ set up the searcher in a worker process """
+    global _worker_searcher
+    _worker_searcher = searcher.TweetSearcher(searchconf)
+    # finish the match files still being written when the pool exits
+    multiprocessing.util.Finalize( None, _worker_searcher.close,
+                                   exitpriority = 10 )
+
+def _searchWorker(tweets):
+    """
+    search a batch of tweets in a worker process, returns the results and
+    the metrics of the search
+    """
+    results = _worker_searcher.searchTweetBatchResults(tweets)
+    return results, metrics.registry.drain()
+
+def _workerResults(async_result):
+    """ return the results of a worker, merging its metrics into ours """
+    results, snap = async_result.get()
+    metrics.registry.merge(snap)
+    return results
+
+def _batches(tweets,size):
+    """ generator of lists of up to size tweets """
+    batch = []
+    for tweet in tweets:
+        batch.append(tweet)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
+def _batchSize(searchconf):
+    """ number of tweets to search together for batched cnn detection """
     try:
-        pickleToFile = args['--pickle-to']
+        return max(1,int(searchconf['batch size']))
     except KeyError:
-        pickleToFile = None
+        return 1
 
-    try:
-        maxCount = int(args['--max'])
-    except ( KeyError, TypeError ):
-        maxCount = None
+class TweetSearch(object):
+    """
+    class to hold what searches tweets, a TweetPipeline, a pool of worker
+    processes or a TweetSearcher, so that it can be reused for several
+    streams of tweets with its known faces and models loaded
+    """
 
-    try:
-        sinceDays = int(args['--since'])
-    except ( KeyError, TypeError):
-        sinceDays = None
+    searchconf = None
+    workers = 1
+    pipelineconf = None
+    batch_size = 1
+
+    tweetpipeline = None
+    pool = None
+    tweetsearcher = None
+
+    def __init__(self,searchconf,workers=1,pipelineconf=None):
+        self.searchconf = searchconf
+        self.workers = workers
+        self.pipelineconf = pipelineconf
+        self.batch_size = _batchSize(searchconf)
 
+        if pipelineconf is not None:
+            log.info('Searching with a pipeline')
+            self.tweetpipeline = pipeline.TweetPipeline(searchconf,pipelineconf)
+        elif workers > 1:
+            # build (or refresh) the known face cache once up front so the
+            # workers all load it instead of each encoding the known photos
+            searcher.Searcher(searchconf)
+
+            log.info('Searching with ' + str(workers) + ' worker processes')
+            # the face detector is already set up in this process, cuda
+            # does not work in a forked copy of it, so the workers are
+            # spawned and set up their own
+            context = multiprocessing.get_context('spawn')
+            self.pool = context.Pool( workers,
+                                      initializer = _initWorker,
+                                      initargs = ( dict(searchconf), ) )
+        else:
+            self.tweetsearcher = searcher.TweetSearcher(searchconf)
+
+    def searchTweets(self,tweets):
+        """
+        generator that searches tweets and yields the list of TweetResults
+        for each tweet, in the same order as tweets
+        """
+        if self.tweetpipeline is not None:
+            for results in self.tweetpipeline.searchTweets(tweets):
+                yield results
+        elif self.pool is not None:
+            # keep a bounded number of tweets in flight so the tweet stream
+            # is not read ahead without limit, and return results in tweet
+            # order regardless of which worker finishes first
+            pending = collections.deque()
+            for batch in _batches(tweets,self.batch_size):
+                pending.append( self.pool.apply_async( _searchWorker, (batch,) ) )
+                if len(pending) >= 2*self.workers:
+                    for results in _workerResults(pending.popleft()):
+                        yield results
+            while pending:
+                for results in _workerResults(pending.popleft()):
+                    yield results
+        else:
+            ts = self.tweetsearcher
+            # media for upcoming tweets downloads while the current one is
+            # being searched
+            for batch in _batches(ts.prefetched(tweets),self.batch_size):
+                for results in ts.searchTweetBatchResults(batch):
+                    yield results
+
+    def close(self):
+        if self.tweetpipeline is not None:
+            self.tweetpipeline.close()
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+        if self.tweetsearcher is not None:
+            self.tweetsearcher.close()
+
+def searchTweets(tweets,searchconf,workers=1,pipelineconf=None):
+    """
+    generator that searches tweets and yields the list of TweetResults for
+    each tweet, in the same order as tweets
+
+    with a pipelineconf, the tweets are searched by a TweetPipeline. with
+    more than one worker, the tweets are searched in a pool of processes,
+    each with its own TweetSearcher. otherwise tweets are searched in
+    batches of the 'batch size' so the cnn detector can run on several
+    photos at once
+    """
+    ts = TweetSearch(searchconf,workers,pipelineconf)
     try:
-        showProgressBar = args['--progress-bar']
-    except KeyError:
-        showProgressBar = False
-        
-    log.debug('pickleToFile = ' + str(pickleToFile))
-    log.debug('pickleFromFile = ' + str(pickleFromFile))
-        
-    # get the configuration file
-    conf_file = args['CONFIGFILE']
+        for results in ts.searchTweets(tweets):
+            yield results
+    finally:
+        ts.close()
 
-    # read the config file and determine what to do
+def readConfig(conf_file):
+    """ read the configuration file """
     config = configparser.ConfigParser()
     config.read(conf_file)
+    return config
 
-    # check if gmail is configured
-    # if the gmail section is not present in the config file, then a Null
-    # Gmail handler will be created that does nothing. 
+def optionalSection(config,name):
+    """ return the section name of config or None if it is not there """
     try:
-        gmailconf = config['gmail']
+        return config[name]
     except KeyError:
+        return None
+
+def openOutbox(config,start=True):
+    """
+    return an Outbox sending with a Gmail for the [gmail] section of
+    config, started unless start is False. if the gmail section is not
+    present in the config file, then a Null Gmail handler will be created
+    that does nothing.
+    """
+    gmailconf = optionalSection(config,'gmail')
+    if gmailconf is None:
         # gmail not configured
         log.info('gmail not configured, emails will not be sent')
-        gmailconf = None
 
     try:
         gm = Gmail(gmailconf)
@@ -103,7 +243,14 @@ if __name__=='__main__':
         # gmail configuration error
         log.error('gmail configuration error')
         raise
-        
+
+    outbox = Outbox(gm,gmailconf)
+    if start:
+        outbox.start()
+    return outbox
+
+def searchConfig(config):
+    """ return the required [search] section of config """
     # require a 'search' section in the config file know what to search fo
     try:
         searchconf = config['search']
@@ -111,101 +258,426 @@ if __name__=='__main__':
         log.exception('Search configuration parameters not configured')
         raise
 
+    return searchconf
+
+def openResultStore(searchconf):
+    """ return the ResultStore for the 'results database' or None """
     # check if configured to write out save file
+    store = ResultStore.fromConfig(searchconf)
+    if store is None:
+        log.info('No configured file for search results')
+    return store
+
+def openTwitter(config):
+    """ return a Twitter for the required [twitter] section of config """
     try:
-        results_save_file = searchconf['save results file']
-        log.info('Will save search results to: ' + results_save_file)
+        twitconfig = config['twitter']
     except KeyError:
-        results_save_file = None
-        log.info('No configured file for search results')
+        log.exception('Twitter not configured')
+        raise
+    return Twitter(twitconfig)
 
+def pipelineConfig(config,usePipeline):
+    """ return the pipeline settings, which are all optional, or None """
+    if not usePipeline:
+        return None
+    pipelineconf = optionalSection(config,'pipeline')
+    if pipelineconf is None:
+        pipelineconf = dict()
+    return pipelineconf
 
-    # require a twitter configuration unless reading from an external file
-    if pickleFromFile:
-        # read tweets from pickle file instead of from twitter api
-        with open(pickleFromFile,'rb') as f:
-            alltweets = pickle.load(f)
-    else:
-        # read the tweets from twitter api directly
-        try:
-            twitconfig = config['twitter']
-        except KeyError:
-            log.exception('Twitter not configured')
-            raise
+def runSearch(alltweets,tweetsearch,outbox,resultstore=None,maxCount=None,
+              showProgressBar=False,reportNone=True):
+    """
+    search the tweets, adding the results to the outbox as they are found
+    to be emailed in the background, and to the resultstore if there is one
 
-        twit = Twitter(twitconfig)
+    with reportNone, an email is also sent when nothing was found
 
-        # get all the tweets
-        # alltweets will be a dict of lists
-        # each dict key is a followed twitter stream
-        alltweets = twit.getAllTweets(sinceDays = sinceDays)
-        #alltweets = twit.getAllTweets()
-        
-    # save the tweets if needed
-    if pickleToFile:
-        # write the tweets to a picklefile
-        with open(pickleToFile,'wb') as f:
-            pickle.dump(alltweets,f)
-        
-    # set up to search the tweets
-    tweetsearcher = searcher.TweetSearcher(searchconf)
-    
-    # search all the tweets
-    # https://stackoverflow.com/questions/952914/making-a-flat-list-out-of-list-of-lists-in-python
-    flatten = lambda l: [item for sublist in l for item in sublist]
-
-    # convert all tweets to a list if needed
-    try:
-        # assume a dictionary
-        alltweets = flatten( alltweets.values() )
-    except AttributeError:
-        # assume it's a list
-        pass
-  
-    if not maxCount:
-        # if maxCount not set, use all tweets at max
-        totlen = len(alltweets)
-    elif len(alltweets) < maxCount:
-        # if fewer tweets found than max count, use that number
-        totlen = len(alltweets)
-    else:
-        # otherwise, process maxcCount at most            
-        totlen = maxCount
+    returns the list of TweetResults and False if the tweets were cut
+    short by maxCount, True if they were all searched
+    """
+    complete = True
+    if maxCount:
+        # process maxCount at most, noting if there were more
+        def limited(tweets):
+            nonlocal complete
+            for i,tweet in enumerate(tweets):
+                if i >= maxCount:
+                    complete = False
+                    return
+                yield tweet
+        alltweets = limited(alltweets)
 
+    # search all the tweets
     searchresults = []
-    if alltweets:
-        for i,tweet in enumerate( alltweets ):
-            # this searches on tweet at a time
-            searchresults.extend( tweetsearcher.searchTweet(tweet) )
-            
+    totlen = 0
+    searching = tweetsearch.searchTweets( alltweets )
+    try:
+        for i,results in enumerate( searching ):
+            searchresults.extend( results )
+            outbox.addResults( results )
+            if resultstore is not None:
+                resultstore.addResults( results )
+            totlen = i+1
+
             # count in progress_bar is i+1 because we start at zero and
             # this should not be zero-based counter
             if showProgressBar:
-                progress_bar.print_progress(i+1,totlen)
-                
-            if i == totlen:
-                break
+                if maxCount:
+                    progress_bar.print_progress(i+1,maxCount)
+                else:
+                    progress_bar.print_count(i+1,prefix='tweets searched:')
+    finally:
+        # an error here stops the search, e.g. the threads of a pipeline
+        searching.close()
 
-    # send email if search results come back
     if searchresults:
+        log.info('Found ' + str(len(searchresults)) + ' results in ' +\
+                 str(totlen) + ' tweets')
+    else:
+        msg = 'Photomongo found no results in ' + str(totlen) + ' tweets.'
+        log.info(msg)
+        if reportNone:
+            outbox.addMessage('photomongo no results', msg)
 
-        # format message to send
-        msg = ''
-        for sr in searchresults:
-            url = 'https://twitter.com/' +\
-                  sr.reference.user.screen_name +\
-                  '/status/' +\
-                  sr.reference.id_str
+    return searchresults, complete
 
-            msg += url + ' at ' + str(sr.match_loc) + '\n\n'
+def compactLedger(searchconf):
+    """ keep the ledger of searched tweets and media from growing forever """
+    ledger = Ledger.fromConfig(searchconf)
+    if ledger is not None:
+        with metrics.timer('ledger_compact'):
+            ledger.compact()
+        ledger.close()
 
-        log.info(msg)
-        gm.create_and_send_message('photomongo results to review',\
-                                   msg)
+class Daemon(object):
+    """
+    class to stay resident and search new tweets every poll interval,
+    keeping the known faces, models and connections loaded between polls
+
+    SIGHUP reloads the configuration file after the current poll, SIGTERM
+    and SIGINT stop after the current poll
+    """
+
+    poll_interval = 15*60 # seconds between polls
+    compact_interval = 24*60*60 # seconds between ledger compactions
+
+    def __init__(self,conf_file,sinceDays=None,workers=1,
+                 usePipeline=False,archiveWriter=None):
+        self.conf_file = conf_file
+        self.sinceDays = sinceDays
+        self.workers = workers
+        self.usePipeline = usePipeline
+        self.archiveWriter = archiveWriter
+
+        self.twit = None
+        self.tweetsearch = None
+        self.outbox = None
+        self.resultstore = None
+        self.lastCompact = time.time()
+        self._wake = threading.Event()
+        self._reload = False
+        self._stop = False
+
+        self.load()
+
+    def load(self):
+        """
+        read the configuration and set up everything a poll needs
+
+        everything new is set up before anything old is closed, so a
+        reload that fails keeps the old configuration running
+        """
+        log.info('Loading configuration from ' + self.conf_file)
+        config = readConfig(self.conf_file)
+
+        metricsconf = optionalSection(config,'metrics')
+        searchconf = searchConfig(config)
+
+        daemonconf = optionalSection(config,'daemon')
+        try:
+            poll_interval = float(daemonconf['poll interval']) * 60
+        except ( KeyError, TypeError ):
+            poll_interval = Daemon.poll_interval
+
+        twit = openTwitter(config)
+        if self.twit is not None:
+            # keep the newest tweets seen so far when there is no state
+            # file to read them back from
+            for feed,since_id in self.twit.since_ids.items():
+                twit.noteNewest(feed,since_id)
+
+        tweetsearch = TweetSearch( searchconf,
+                                   self.workers,
+                                   pipelineConfig(config,self.usePipeline) )
+        resultstore = None
+        try:
+            resultstore = openResultStore(searchconf)
+            # not started yet, the old outbox may still be sending from the
+            # same spool
+            outbox = openOutbox(config,start=False)
+        except Exception:
+            tweetsearch.close()
+            if resultstore is not None:
+                resultstore.close()
+            raise
+
+        if self.tweetsearch is not None:
+            self.tweetsearch.close()
+        if self.resultstore is not None:
+            self.resultstore.close()
+        # the old outbox sends what it has before the new one takes over
+        if self.outbox is not None:
+            self.outbox.close()
+        outbox.start()
+
+        self.metricsconf = metricsconf
+        self.searchconf = searchconf
+        self.poll_interval = poll_interval
+        self.twit = twit
+        self.tweetsearch = tweetsearch
+        self.resultstore = resultstore
+        self.outbox = outbox
+
+    def _signal(self,signum,frame):
+        if signum == signal.SIGHUP:
+            log.info('Reload requested')
+            self._reload = True
+        else:
+            log.info('Stop requested')
+            self._stop = True
+        self._wake.set()
+
+    def poll(self):
+        """ search the tweets posted since the last poll """
+        pollStart = time.time()
+
+        alltweets = self.twit.iterAllTweets(sinceDays = self.sinceDays)
+        if self.archiveWriter is not None:
+            alltweets = self.archiveWriter.archived(alltweets)
+
+        # a failed poll fetches the same tweets again next time
+        since_ids = dict(self.twit.since_ids)
+        try:
+            searchresults, _ = runSearch( alltweets,
+                                          self.tweetsearch,
+                                          self.outbox,
+                                          resultstore = self.resultstore,
+                                          reportNone = False )
+        except Exception:
+            self.twit.since_ids = since_ids
+            raise
+
+        if self.archiveWriter is not None:
+            self.archiveWriter.flush()
+
+        if time.time() - self.lastCompact > self.compact_interval:
+            compactLedger(self.searchconf)
+            self.lastCompact = time.time()
+
+        self.twit.saveState()
+
+        metrics.count('polls')
+        metrics.gauge('poll_seconds', time.time() - pollStart)
+        metrics.gauge('search_results', len(searchresults))
+        metrics.writeMetrics(self.metricsconf)
+
+    def run(self):
+        """ poll until stopped """
+        signal.signal(signal.SIGHUP, self._signal)
+        signal.signal(signal.SIGTERM, self._signal)
+        signal.signal(signal.SIGINT, self._signal)
+
+        try:
+            while not self._stop:
+                try:
+                    self.poll()
+                except Exception:
+                    # a failed poll, e.g. twitter being down, is tried again
+                    # on the next one
+                    log.exception('Poll failed')
+                    metrics.count('poll_errors')
+
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+
+                if self._reload and not self._stop:
+                    self._reload = False
+                    try:
+                        self.load()
+                    except Exception:
+                        log.exception('Could not reload ' + self.conf_file +\
+                                      ', keeping the old configuration')
+        finally:
+            self.tweetsearch.close()
+            self.outbox.close()
+            if self.resultstore is not None:
+                self.resultstore.close()
+            log.info('Stopped')
+
+if __name__=='__main__':
+    
+    args = docopt(__doc__)
+
+    try:
+        pickleFromFile = args['--pickle-from']
+    except KeyError:
+        pickleFromFile = None
+
+    try:
+        archiveFromFile = args['--archive-from']
+    except KeyError:
+        archiveFromFile = None
+
+    try:
+        archiveToFile = args['--archive-to']
+    except KeyError:
+        archiveToFile = None
+
+    try:
+        archiveIds = args['--ids'].split(',')
+    except ( KeyError, AttributeError ):
+        archiveIds = None
+
+    try:
+        maxCount = int(args['--max'])
+    except ( KeyError, TypeError ):
+        maxCount = None
+
+    try:
+        sinceDays = int(args['--since'])
+    except ( KeyError, TypeError):
+        sinceDays = None
+
+    try:
+        showProgressBar = args['--progress-bar']
+    except KeyError:
+        showProgressBar = False
+
+    try:
+        nWorkers = int(args['--workers'])
+    except ( KeyError, TypeError ):
+        nWorkers = 1
+
+    try:
+        usePipeline = args['--pipeline']
+    except KeyError:
+        usePipeline = False
+
+    try:
+        runDaemon = args['--daemon']
+    except KeyError:
+        runDaemon = False
+        
+    log.debug('archiveToFile = ' + str(archiveToFile))
+    log.debug('archiveFromFile = ' + str(archiveFromFile))
+    log.debug('pickleFromFile = ' + str(pickleFromFile))
+        
+    runStart = time.time()
+
+    # get the configuration file
+    conf_file = args['CONFIGFILE']
+
+    # save the tweets as they stream past if needed
+    archiveWriter = None
+    if archiveToFile:
+        archiveWriter = ArchiveWriter(archiveToFile)
+
+    if runDaemon:
+        if pickleFromFile or archiveFromFile:
+            sys.exit('--daemon polls twitter, it can not replay saved tweets')
+        if maxCount:
+            # a poll cut short would either skip the rest of the new
+            # tweets or fetch the same ones again every poll
+            sys.exit('--daemon searches every new tweet, it can not use --max')
+
+        daemon = Daemon( conf_file,
+                         sinceDays = sinceDays,
+                         workers = nWorkers,
+                         usePipeline = usePipeline,
+                         archiveWriter = archiveWriter )
+        try:
+            daemon.run()
+        finally:
+            if archiveWriter is not None:
+                archiveWriter.close()
+        sys.exit(0)
+
+    # read the config file and determine what to do
+    config = readConfig(conf_file)
+
+    # metrics files are only written if the section is present
+    metricsconf = optionalSection(config,'metrics')
+
+    outbox = openOutbox(config)
+    searchconf = searchConfig(config)
+    resultstore = openResultStore(searchconf)
+
+    # require a twitter configuration unless reading from an external file
+    twit = None
+    if pickleFromFile:
+        # read tweets from pickle file instead of from twitter api
+        with open(pickleFromFile,'rb') as f:
+            alltweets = pickle.load(f)
+
+        # convert all tweets to a single stream if needed
+        try:
+            # assume a dictionary of lists
+            alltweets = itertools.chain.from_iterable( alltweets.values() )
+        except AttributeError:
+            # assume it's a list
+            pass
+    elif archiveFromFile:
+        # replay tweets from an archive, only reading the parts needed for
+        # the --since days and --ids
+        if sinceDays:
+            start_date = datetime.datetime.now() -\
+                         datetime.timedelta( days = sinceDays )
+        else:
+            start_date = None
+        alltweets = ArchiveReader(archiveFromFile).iterTweets( ids = archiveIds,
+                                                               start_date = start_date )
     else:
-        msg = 'Photomongo found no results in ' + str(totlen) + ' tweets.'
-        log.info(msg)
-        gm.create_and_send_message('photomongo no results',\
-                                   msg)
+        # read the tweets from twitter api directly
+        twit = openTwitter(config)
+
+        # stream all the tweets, one page at a time, so searching starts
+        # on the first page
+        alltweets = twit.iterAllTweets(sinceDays = sinceDays)
+        
+    if archiveWriter is not None:
+        alltweets = archiveWriter.archived(alltweets)
+
+    tweetsearch = TweetSearch( searchconf,
+                               nWorkers,
+                               pipelineConfig(config,usePipeline) )
+    try:
+        searchresults, complete = runSearch( alltweets, tweetsearch, outbox,
+                                             resultstore = resultstore,
+                                             maxCount = maxCount,
+                                             showProgressBar = showProgressBar )
+    finally:
+        tweetsearch.close()
+        # wait for the emails to go out
+        outbox.close()
+        if resultstore is not None:
+            resultstore.close()
+        # keep the tweets archived so far when the search fails
+        if archiveWriter is not None:
+            archiveWriter.close()
+
+    compactLedger(searchconf)
+
+    # the fetched tweets were all searched, so the next run only needs
+    # tweets newer than these. a run cut short by --max leaves the state
+    # alone so the tweets it did not get to are searched next time
+    if twit is not None:
+        if complete:
+            twit.saveState()
+        else:
+            log.info('Search stopped at --max, not saving the newest tweet ids')
 
-            
+    metrics.gauge('run_seconds', time.time() - runStart)
+    metrics.gauge('search_results', len(searchresults))
+    metrics.writeMetrics(metricsconf)
@@ -0,0 +1,464 @@
+"""
+pipeline.py
+
+search tweets in a pipeline of stages connected by bounded queues:
+
+  fetch -> download -> decode -> detect -> match -> sink
+
+each stage has its own number of workers. i/o stages run in threads,
+detection runs in a pool of processes. a full queue blocks the stage
+feeding it, so a slow stage holds back the ones before it instead of
+letting work pile up in memory. the occupancy of each stage is logged
+periodically so the slow stage can be found and given more workers.
+
+when the reader of a pipeline stops early, e.g. on an error, the stages
+are cancelled, their workers drop what they hold and exit and the queues
+are emptied.
+"""
+import logging
+log = logging.getLogger(__name__)
+
+import os
+import time
+import queue
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import searcher
+import metrics
+
+# marks the end of the work put into a queue
+_STOP = object()
+
+# seconds between checks for cancellation by a worker waiting on a queue
+_POLL = 0.1
+
+def _put(q,item,cancel):
+    """
+    put item on q, waiting while q is full, returns False if cancel was set
+    before it could be put
+    """
+    while not cancel.is_set():
+        try:
+            q.put(item, timeout = _POLL)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def _drain(q):
+    """ drop everything waiting in q """
+    while True:
+        try:
+            q.get_nowait()
+        except queue.Empty:
+            return
+
+class Stage(object):
+    """
+    class for one stage of a pipeline, a set of worker threads that take
+    items from an input queue, call func on each and put the result on
+    the output queue
+    """
+
+    name = None
+    func = None
+    workers = 1
+
+    inq = None # bounded input queue
+    outq = None # input queue of the next stage
+
+    busy = 0 # number of workers currently running func
+    processed = 0 # number of items processed
+    busy_time = 0.0 # total seconds spent in func
+
+    def __init__(self,name,func,workers=1,queue_size=32):
+        self.name = name
+        self.func = func
+        self.workers = max(1,workers)
+        self.inq = queue.Queue(maxsize = queue_size)
+        self._lock = threading.Lock()
+        self._running = 0
+        self._threads = []
+        self._cancel = threading.Event()
+
+    def start(self,outq,cancel=None):
+        """
+        start the worker threads, sending results to outq. the workers exit
+        without finishing their work when the cancel event is set
+        """
+        self.outq = outq
+        if cancel is not None:
+            self._cancel = cancel
+        self._running = self.workers
+        for i in range(self.workers):
+            t = threading.Thread( target = self._run,
+                                  name = self.name + '-' + str(i),
+                                  daemon = True )
+            t.start()
+            self._threads.append(t)
+
+    def _run(self):
+        while True:
+            try:
+                item = self.inq.get(timeout = _POLL)
+            except queue.Empty:
+                if self._cancel.is_set():
+                    return
+                continue
+            if self._cancel.is_set():
+                return
+
+            if item is _STOP:
+                # pass the stop on to the other workers of this stage, the
+                # last one to finish passes it on to the next stage
+                _put(self.inq, _STOP, self._cancel)
+                with self._lock:
+                    self._running -= 1
+                    last = self._running == 0
+                if last:
+                    _put(self.outq, _STOP, self._cancel)
+                return
+
+            with self._lock:
+                self.busy += 1
+            t0 = time.time()
+            try:
+                item = self.func(item)
+            except Exception:
+                log.exception('error in pipeline stage ' + self.name)
+            finally:
+                with self._lock:
+                    self.busy -= 1
+                    self.processed += 1
+                    self.busy_time += time.time() - t0
+
+            if not _put(self.outq, item, self._cancel):
+                return
+
+    def join(self):
+        """ wait for the worker threads to exit """
+        for t in self._threads:
+            t.join()
+        self._threads = []
+
+    def occupancy(self):
+        """ return a string describing how full and how busy the stage is """
+        return self.name + ': queue ' + str(self.inq.qsize()) + '/' +\
+            str(self.inq.maxsize) + ' busy ' + str(self.busy) + '/' +\
+            str(self.workers) + ' done ' + str(self.processed)
+
+class Pipeline(object):
+    """
+    class to connect stages and feed them from a source iterator
+    """
+
+    stages = None
+    sinkq = None # queue holding the output of the last stage
+
+    report_interval = 30.0 # seconds between occupancy reports
+
+    def __init__(self,stages,queue_size=32,report_interval=None):
+        self.stages = stages
+        self.sinkq = queue.Queue(maxsize = queue_size)
+        if report_interval is not None:
+            self.report_interval = report_interval
+        self._done = threading.Event()
+        self._cancel = threading.Event()
+        self._source_error = None
+
+    def report(self):
+        """ log the occupancy of all the stages """
+        log.info('pipeline ' + ', '.join([ s.occupancy() for s in self.stages ]))
+
+    def _reporter(self):
+        while not self._done.wait(self.report_interval):
+            self.report()
+
+    def _feed(self,source):
+        inq = self.stages[0].inq
+        try:
+            for item in source:
+                if not _put(inq, item, self._cancel):
+                    return
+        except Exception as e:
+            log.exception('error reading pipeline source')
+            self._source_error = e
+        finally:
+            _put(inq, _STOP, self._cancel)
+
+    def cancel(self):
+        """
+        stop the stages without finishing the work in them, dropping the
+        items waiting in the queues
+        """
+        log.info('pipeline cancelled')
+        self._cancel.set()
+        for stage in self.stages:
+            _drain(stage.inq)
+        _drain(self.sinkq)
+        for stage in self.stages:
+            stage.join()
+        # items put by workers that were already putting when cancelled
+        for stage in self.stages:
+            _drain(stage.inq)
+        _drain(self.sinkq)
+
+    def run(self,source):
+        """
+        generator that pushes the items from source through all the stages
+        and yields the items coming out of the last stage, in the order
+        they finish
+        """
+        for i,stage in enumerate(self.stages):
+            if i+1 < len(self.stages):
+                stage.start(self.stages[i+1].inq,self._cancel)
+            else:
+                stage.start(self.sinkq,self._cancel)
+
+        threading.Thread( target = self._feed,
+                          args = (source,),
+                          name = 'fetch',
+                          daemon = True ).start()
+        if self.report_interval > 0:
+            threading.Thread( target = self._reporter,
+                              name = 'pipeline-report',
+                              daemon = True ).start()
+
+        finished = False
+        try:
+            while True:
+                item = self.sinkq.get()
+                if item is _STOP:
+                    break
+                yield item
+            finished = True
+        finally:
+            self._done.set()
+            if not finished:
+                # the reader stopped early
+                self.cancel()
+
+        self.report()
+        for stage in self.stages:
+            if stage.processed:
+                log.info('pipeline ' + stage.name + ': ' +\
+                         str(stage.processed) + ' items, ' +\
+                         '%.1f' % stage.busy_time + ' busy seconds')
+
+        if self._source_error is not None:
+            raise self._source_error
+
+# each detect process builds its own searcher once, see _initDetector
+_detect_searcher = None
+
+def _initDetector(searchconf):
+    """ set up the searcher in a detect process """
+    global _detect_searcher
+    _detect_searcher = searcher.Searcher(searchconf)
+
+def _detectImage(im):
+    """ find and encode the faces in im in a detect process """
+    locations = _detect_searcher.detectFaces(im)
+    return locations, _detect_searcher.encodeFaces(im, locations)
+
+class TweetEntry(object):
+    """
+    class to collect the results of one tweet as its media finish
+    """
+
+    seq = None # position of the tweet in the stream
+    tweet = None
+    textmatch = None
+    media = None # list of MediaItems
+    received = 0 # number of media items that reached the sink
+    skip = False # True if the tweet was searched on an earlier run
+
+    def __init__(self,seq,tweet,textmatch,media):
+        self.seq = seq
+        self.tweet = tweet
+        self.textmatch = textmatch
+        self.media = media
+        for item in media:
+            item.entry = self
+            item.resolved = False
+
+class TweetPipeline(object):
+    """
+    class to search a stream of tweets with a Pipeline
+    """
+
+    download_workers = None # defaults to the downloader threads
+    decode_workers = 2
+    detect_workers = None # defaults to the number of cpus
+    queue_size = 32
+    report_interval = 30.0
+
+    # detect processes, started on the first search and kept until close
+    # so later searches reuse their loaded models
+    _executor = None
+
+    def __init__(self,searchconf,pipelineconf=None):
+
+        if pipelineconf is None:
+            pipelineconf = dict()
+
+        self.searchconf = dict(searchconf)
+        self.tweetsearcher = searcher.TweetSearcher(self.searchconf)
+
+        try:
+            self.download_workers = int(pipelineconf['download workers'])
+        except KeyError:
+            self.download_workers = self.tweetsearcher.downloader.threads
+        try:
+            self.decode_workers = int(pipelineconf['decode workers'])
+        except KeyError:
+            pass
+        try:
+            self.detect_workers = int(pipelineconf['detect workers'])
+        except KeyError:
+            self.detect_workers = os.cpu_count() or 1
+        try:
+            self.queue_size = int(pipelineconf['queue size'])
+        except KeyError:
+            pass
+        try:
+            self.report_interval = float(pipelineconf['report interval'])
+        except KeyError:
+            pass
+
+    def _step(self,step):
+        """
+        wrap a media step so it is skipped for items that were already
+        resolved and for tweets without media
+        """
+        def run(item):
+            if isinstance(item,TweetEntry) or item.resolved:
+                return item
+            try:
+                if step(item):
+                    item.resolved = True
+            except Exception:
+                log.exception('error searching ' + item.url)
+                item.failed = True
+                item.resolved = True
+            return item
+        return run
+
+    def _source(self,tweets):
+        """ generator of work for the first stage, one entry per tweet """
+        ts = self.tweetsearcher
+        for seq,tweet in enumerate(tweets):
+            if ts.alreadySearched(tweet):
+                entry = TweetEntry(seq,tweet,[],[])
+                entry.skip = True
+                yield entry
+                continue
+
+            entry = TweetEntry(seq,tweet,ts.searchTweetText(tweet),
+                               ts.mediaItems(tweet))
+            if entry.media:
+                for item in entry.media:
+                    yield item
+            else:
+                yield entry
+
+    def _download(self,item):
+        ts = self.tweetsearcher
+        return ts.lookupMedia(item) or ts.downloadMedia(item)
+
+    def _detect(self,item):
+        # timed here, the detect processes do not report their metrics
+        with metrics.timer('detect'):
+            future = self._executor.submit(_detectImage, item.image)
+            item.locations, item.encodings = future.result()
+        return False
+
+    def _match(self,item):
+        ts = self.tweetsearcher
+        ts.matchMedia(item)
+        # a larger variant is rare, so search it here rather than send it
+        # back through the earlier stages
+        while ts.largerVariant(item):
+            if ts.downloadMedia(item) or ts.decodeMedia(item):
+                break
+            self._detect(item)
+            ts.matchMedia(item)
+        # the downloaded bytes are not needed past this point, unless they
+        # are written out as the match file
+        if not ( item.matches and ts.match_output == 'original' ):
+            item.data = None
+        return False
+
+    def searchTweets(self,tweets):
+        """
+        generator that searches tweets and yields the list of TweetResults
+        for each tweet, in the same order as tweets. may be called again
+        for more tweets until close is called
+        """
+        ts = self.tweetsearcher
+
+        if self._executor is None:
+            # the detect processes start from the first detect thread while
+            # the other stages are running, with the face detector already
+            # set up here. a forked process could inherit a lock held by
+            # one of those threads, and cuda does not work after a fork,
+            # so they are spawned
+            self._executor = ProcessPoolExecutor( max_workers = self.detect_workers,
+                                                  mp_context = multiprocessing.get_context('spawn'),
+                                                  initializer = _initDetector,
+                                                  initargs = ( self.searchconf, ) )
+
+        stages = [ Stage('download', self._step(self._download),
+                         self.download_workers, self.queue_size),
+                   Stage('decode', self._step(ts.decodeMedia),
+                         self.decode_workers, self.queue_size),
+                   Stage('detect', self._step(self._detect),
+                         self.detect_workers, self.queue_size),
+                   Stage('match', self._step(self._match),
+                         1, self.queue_size) ]
+        pipeline = Pipeline( stages,
+                             queue_size = self.queue_size,
+                             report_interval = self.report_interval )
+
+        # the sink records each media item as it finishes and yields the
+        # tweets in order once all of their media are done
+        finished = dict()
+        nextseq = 0
+        items = pipeline.run(self._source(tweets))
+        try:
+            for item in items:
+                if isinstance(item,TweetEntry):
+                    entry = item
+                else:
+                    entry = item.entry
+                    item.results = ts.recordMedia(item)
+                    # drop the image, the writer keeps it until it is written
+                    item.image = None
+                    entry.received += 1
+                    if entry.received < len(entry.media):
+                        continue
+
+                if not entry.skip:
+                    ts.finishTweet(entry.tweet,entry.media)
+                finished[entry.seq] = entry
+
+                while nextseq in finished:
+                    entry = finished.pop(nextseq)
+                    nextseq += 1
+                    sr = []
+                    for m in entry.media:
+                        sr += m.results
+                    sr += entry.textmatch
+                    yield [ searcher.TweetResult(r) for r in sr ]
+        finally:
+            # cancels the pipeline when our reader stopped early
+            items.close()
+
+    def close(self):
+        """ stop the detect processes and close the searcher """
+        if self._executor is not None:
+            self._executor.shutdown(wait = True)
+            self._executor = None
+        self.tweetsearcher.close()
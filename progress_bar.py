@@ -26,3 +26,15 @@ def print_progress(iteration, total, prefix='', suffix='', decimals=1, bar_lengt
     if iteration == total:
         sys.stdout.write('\n')
     sys.stdout.flush()
+
+# Print a running count when the total is not known
+def print_count(iteration, prefix='', suffix=''):
+    """
+    Call in a loop to show a running count on the terminal
+    @params:
+        iteration   - Required  : current iteration (Int)
+        prefix      - Optional  : prefix string (Str)
+        suffix      - Optional  : suffix string (Str)
+    """
+    sys.stdout.write('\r%s %d %s' % (prefix, iteration, suffix))
+    sys.stdout.flush()
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+"""
+resultstore.py
+
+sqlite store of every match found, written as each tweet is searched, so
+months of matches can be reviewed by person, feed and date without going
+through the files in the photo match directory.
+
+Usage:
+  resultstore.py [options] RESULTSFILE
+
+Options:
+  -h --help          Show this screen.
+  --name=<name>      only matches of this known face or search text
+  --feed=<feed>      only matches in tweets from this feed
+  --since=<date>     only tweets posted on or after this date, YYYY-MM-DD
+  --until=<date>     only tweets posted before this date, YYYY-MM-DD
+  --limit=<n>        show at most this many matches, newest first
+  --json             print json lines instead of a table
+"""
+import logging
+log = logging.getLogger(__name__)
+
+import sqlite3
+import time
+import json
+import calendar
+import datetime
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    id INTEGER PRIMARY KEY,
+    tweet_id TEXT NOT NULL,
+    feed TEXT NOT NULL,
+    posted REAL,
+    found REAL NOT NULL,
+    kind TEXT NOT NULL,
+    match_name TEXT NOT NULL,
+    distance REAL,
+    box TEXT NOT NULL,
+    image TEXT,
+    UNIQUE (tweet_id, match_name, box)
+);
+CREATE INDEX IF NOT EXISTS results_name ON results (match_name, posted);
+CREATE INDEX IF NOT EXISTS results_feed ON results (feed, posted);
+CREATE INDEX IF NOT EXISTS results_posted ON results (posted);
+"""
+
+# columns returned by queries
+COLUMNS = ( 'tweet_id', 'feed', 'posted', 'found', 'kind', 'match_name',
+            'distance', 'box', 'image' )
+
+def tweetTime(created_at):
+    """ return a tweepy created_at utc datetime as seconds since the epoch """
+    if created_at is None:
+        return None
+    return calendar.timegm(created_at.utctimetuple())
+
+class ResultStore(object):
+    """
+    class to append search results to the store and query them
+
+    a result found again, e.g. when a tweet is searched again without a
+    ledger, is only stored once
+    """
+
+    results_file = None
+    conn = None
+
+    def __init__(self,results_file):
+        self.results_file = results_file
+        self.conn = sqlite3.connect(results_file, timeout = 60)
+        # appends from one run do not block readers reviewing results
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript(_SCHEMA)
+        self.conn.commit()
+
+    @classmethod
+    def fromConfig(cls,searchconfig):
+        """
+        return a ResultStore for the 'results database' in searchconfig or
+        None if it is not configured
+        """
+        try:
+            results_file = searchconfig['results database']
+        except KeyError:
+            # older configurations named a json file here, which can not
+            # be opened as the database
+            if 'save results file' in searchconfig:
+                log.warning('save results file is no longer used, set'
+                            ' results database to keep the search results')
+            return None
+        log.info('Will save search results to: ' + results_file)
+        return cls(results_file)
+
+    def addResults(self,results):
+        """ store a list of TweetResults, committing them together """
+        if not results:
+            return
+        found = time.time()
+        rows = []
+        for r in results:
+            # text matches have no box, '' rather than null so the unique
+            # constraint applies to them too
+            if r.kind == 'face':
+                box = json.dumps(list(r.match_loc))
+            else:
+                box = ''
+            rows.append( ( r.id_str, r.screen_name, r.posted, found, r.kind,
+                           r.match_name, r.distance, box, r.filename ) )
+        with self.conn:
+            self.conn.executemany('INSERT OR IGNORE INTO results'
+                                  ' (tweet_id, feed, posted, found, kind,'
+                                  ' match_name, distance, box, image)'
+                                  ' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def query(self,name=None,feed=None,start=None,end=None,limit=None):
+        """
+        return a list of dicts of the stored results, newest tweet first
+
+        name = None - only this match name
+        feed = None - only tweets from this feed
+        start = None - only tweets posted at or after this datetime
+        end = None - only tweets posted before this datetime
+        limit = None - at most this many results
+        """
+        where = []
+        args = []
+        if name is not None:
+            where.append('match_name = ?')
+            args.append(name)
+        if feed is not None:
+            where.append('feed = ? COLLATE NOCASE')
+            args.append(feed)
+        if start is not None:
+            where.append('posted >= ?')
+            args.append(start.timestamp())
+        if end is not None:
+            where.append('posted < ?')
+            args.append(end.timestamp())
+
+        sql = 'SELECT ' + ', '.join(COLUMNS) + ' FROM results'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY posted DESC, id DESC'
+        if limit is not None:
+            sql += ' LIMIT ?'
+            args.append(limit)
+
+        rows = []
+        for row in self.conn.execute(sql,args):
+            row = dict(zip(COLUMNS,row))
+            row['box'] = json.loads(row['box']) if row['box'] else None
+            rows.append(row)
+        return rows
+
+    def close(self):
+        self.conn.close()
+
+def _date(s):
+    if s is None:
+        return None
+    return datetime.datetime.strptime(s, '%Y-%m-%d').replace(
+        tzinfo = datetime.timezone.utc)
+
+if __name__=='__main__':
+
+    from docopt import docopt
+    args = docopt(__doc__)
+
+    store = ResultStore(args['RESULTSFILE'])
+    rows = store.query( name = args['--name'],
+                        feed = args['--feed'],
+                        start = _date(args['--since']),
+                        end = _date(args['--until']),
+                        limit = int(args['--limit']) if args['--limit'] else None )
+    store.close()
+
+    for row in rows:
+        if args['--json']:
+            print(json.dumps(row))
+            continue
+        posted = datetime.datetime.utcfromtimestamp(row['posted']).strftime('%Y-%m-%d %H:%M') \
+                 if row['posted'] is not None else '?'
+        distance = '%.3f' % row['distance'] if row['distance'] is not None else '-'
+        print( posted + '  ' + row['feed'] + '  ' + row['match_name'] + '  ' +\
+               distance + '  https://twitter.com/' + row['feed'] + '/status/' +\
+               row['tweet_id'] + ( '  ' + row['image'] if row['image'] else '' ) )
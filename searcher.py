@@ -8,17 +8,178 @@ log = logging.getLogger(__name__)
 log.info('hello logging')
 
 import glob
-import face_recognition
 import os
-import requests
-from PIL import Image, ImageDraw
 import numpy as np
 
-import json
+# face_recognition loads dlib and its models, so it and PIL are only
+# imported when photos are searched
+from lazy import LazyModule
+face_recognition = LazyModule('face_recognition')
+Image = LazyModule('PIL.Image')
+
+import io
+import collections
+
+from facecache import FaceCache
+from downloader import MediaDownloader, DownloaderError
+from ledger import Ledger, digestBytes
+from perceptual import dhash, canHash, rescaleLocation, HashIndex
+from textmatch import KeywordMatcher, parseKeywords
+from resultstore import tweetTime
+from writer import MatchWriter, writeImage, imageExtension
+import metrics
 
 class SearcherError(Exception):
     pass
 
+# smallest face, in pixels, that the hog detector finds reliably with one
+# upsample of the image
+HOG_MIN_FACE = 40
+
+def resizeImage(im,scale):
+    """ return the rgb numpy array im resized by scale """
+    h,w = im.shape[:2]
+    size = ( max(1,int(round(w*scale))), max(1,int(round(h*scale))) )
+    return np.asarray( Image.fromarray(im).resize( size,
+                                                   Image.BILINEAR,
+                                                   reducing_gap = 2.0 ) )
+
+def decodeImage(data,long_edge=None):
+    """
+    decode image file bytes to a contiguous uint8 rgb numpy array
+
+    if long_edge is given, larger images are decoded at a reduced size of at
+    least long_edge pixels on the long side. long_edge may also be a
+    function of the original (width, height). jpeg images are scaled while
+    decoding with draft, other formats are reduced by an integer factor.
+
+    returns the array and the (width, height) of the original image
+    """
+    im = Image.open(io.BytesIO(data))
+    size = im.size
+    fmt = im.format
+
+    if callable(long_edge):
+        long_edge = long_edge(*size)
+
+    reduce = long_edge and max(size) > long_edge
+
+    if reduce and fmt == 'JPEG':
+        # the jpeg decoder scales by 1/2, 1/4 or 1/8 to at least this size
+        ratio = long_edge / float(max(size))
+        im.draft('RGB', ( int(np.ceil(size[0]*ratio)),
+                          int(np.ceil(size[1]*ratio)) ))
+
+    # one conversion handles palette, grayscale, alpha and cmyk images, and
+    # asarray of an rgb image needs no further copy
+    if im.mode != 'RGB':
+        im = im.convert('RGB')
+
+    if reduce and fmt != 'JPEG':
+        factor = int(max(size) // long_edge)
+        if factor > 1:
+            im = im.reduce(factor)
+
+    return np.asarray(im), size
+
+def boxOverlap(a,b):
+    """ return the intersection over union of two (t, r, b, l) boxes """
+    top = max(a[0],b[0])
+    right = min(a[1],b[1])
+    bottom = min(a[2],b[2])
+    left = max(a[3],b[3])
+    if right <= left or bottom <= top:
+        return 0.0
+    inter = (right-left) * (bottom-top)
+    area = lambda x: (x[1]-x[3]) * (x[2]-x[0])
+    return inter / float( area(a) + area(b) - inter )
+
+def mergeLocations(locations,overlap=0.3):
+    """ drop boxes that overlap an earlier box by more than overlap """
+    merged = []
+    for loc in locations:
+        if all( boxOverlap(loc,m) <= overlap for m in merged ):
+            merged.append(loc)
+    return merged
+
+def imageTiles(width,height,size,overlap):
+    """
+    yield (top, right, bottom, left) tiles of at most size pixels covering a
+    (width x height) image, neighboring tiles overlapping by overlap pixels
+    """
+    step = max(1, size - overlap)
+    for top in range(0, max(1, height - overlap), step):
+        for left in range(0, max(1, width - overlap), step):
+            yield ( top, min(width, left+size), min(height, top+size), left )
+
+def skinMask(im):
+    """
+    return a boolean array of the pixels in im with a skin-like color, a
+    cheap hint that an image may contain people
+    """
+    im = np.asarray(im, dtype=np.float32)
+    r,g,b = im[:,:,0], im[:,:,1], im[:,:,2]
+    cr = 128.0 + 0.5*r - 0.418688*g - 0.081312*b
+    cb = 128.0 - 0.168736*r - 0.331264*g + 0.5*b
+    return (cr >= 133) & (cr <= 173) & (cb >= 77) & (cb <= 127)
+
+def skinRegions(im,min_fraction,cells=8):
+    """
+    return (top, right, bottom, left) boxes around the skin colored parts
+    of im
+
+    a 64 pixel thumbnail of im is split into a grid of cells x cells, the
+    cells with at least min_fraction skin colored pixels are joined with
+    their neighbors, and each group gives a box grown by one cell
+    """
+    height,width = im.shape[:2]
+    small = resizeImage(im, min(1.0, 64.0/max(width,height)))
+    mask = skinMask(small).astype(np.float64)
+    h,w = mask.shape
+    nrows = min(cells,h)
+    ncols = min(cells,w)
+    rows = np.linspace(0,h,nrows+1).astype(np.intp)
+    cols = np.linspace(0,w,ncols+1).astype(np.intp)
+    counts = np.outer(np.diff(rows),np.diff(cols))
+    sums = np.add.reduceat(np.add.reduceat(mask,rows[:-1],axis=0),cols[:-1],axis=1)
+    skin = sums / counts >= min_fraction
+
+    regions = []
+    seen = np.zeros_like(skin)
+    for start in zip(*np.nonzero(skin)):
+        if seen[start]:
+            continue
+        # flood fill the group of skin cells this one belongs to
+        seen[start] = True
+        stack = [start]
+        y0,x0,y1,x1 = start[0],start[1],start[0],start[1]
+        while stack:
+            y,x = stack.pop()
+            y0,x0,y1,x1 = min(y0,y),min(x0,x),max(y1,y),max(x1,x)
+            for yy,xx in ( (y-1,x), (y+1,x), (y,x-1), (y,x+1) ):
+                if 0 <= yy < nrows and 0 <= xx < ncols and \
+                   skin[yy,xx] and not seen[yy,xx]:
+                    seen[yy,xx] = True
+                    stack.append( (yy,xx) )
+        y0,x0 = max(0,y0-1), max(0,x0-1)
+        y1,x1 = min(nrows,y1+2), min(ncols,x1+2)
+        regions.append( ( int(rows[y0] * height // h),
+                          int(cols[x1] * width // w),
+                          int(rows[y1] * height // h),
+                          int(cols[x0] * width // w) ) )
+    return regions
+
+def scaleLocation(loc,scale,width,height):
+    """
+    map a (top, right, bottom, left) box found in an image resized by scale
+    back to the (width x height) image
+    """
+    top,right,bottom,left = loc
+    return ( max(0,int(round(top/scale))),
+             min(width,int(round(right/scale))),
+             min(height,int(round(bottom/scale))),
+             max(0,int(round(left/scale))) )
+
 class SearchResult(object):
     """
     class to hold the result of a search
@@ -28,6 +189,7 @@ class SearchResult(object):
     match = None # item searched for reference
     match_name = None # name of matching item, string
     match_loc = None # location of matching item
+    distance = None # face distance of a photo match
     
     def __init__(self,*args,**kwargs):
 
@@ -44,9 +206,124 @@ class SearchResult(object):
         except KeyError:
             pass
 
+        try:
+            self.distance = kwargs['distance']
+        except KeyError:
+            pass
+
+    def __str__(self):
+        return self.match_name
+
+class TweetResult(object):
+    """
+    small, picklable summary of a SearchResult found in a tweet, safe to
+    pass between processes
+    """
+
+    screen_name = None # feed the tweet came from
+    id_str = None # tweet id
+    posted = None # time the tweet was posted, seconds since the epoch
+    kind = None # 'face' for a photo match, 'text' for a text match
+    match_name = None
+    match_loc = None
+    distance = None
+    filename = None # image file written for the match, if any
+
+    def __init__(self,sr):
+        tweet = sr.reference
+        self.screen_name = tweet.user.screen_name
+        self.id_str = tweet.id_str
+        self.posted = tweetTime(getattr(tweet,'created_at',None))
+        self.match_name = sr.match_name
+        self.match_loc = sr.match_loc
+        # text matches are located by the index of the search text
+        self.kind = 'face' if isinstance(sr.match_loc,(tuple,list)) else 'text'
+        self.distance = sr.distance
+        self.filename = getattr(sr,'filename',None)
+
+    def url(self):
+        """ return the url of the matching tweet """
+        return 'https://twitter.com/' + self.screen_name +\
+               '/status/' + self.id_str
+
     def __str__(self):
         return self.match_name
 
+class MediaItem(object):
+    """
+    class to carry one media item of a tweet through the search steps
+    """
+
+    tweet = None
+    url = None # url downloaded, may be a smaller variant of the media
+    key = None # media_url the ledger records the media under
+    index = None # position of the media in the tweet
+    media = None # the twitter media entity
+    variant = None # name of the size variant in url, or None
+
+    data = None # downloaded bytes
+    digest = None # hash of data
+    image = None # decoded rgb numpy array
+    size = None # (width, height) of image
+    original_size = None # (width, height) of the image before decoding
+    hash = None # perceptual hash of image
+
+    locations = None # face locations found in image
+    encodings = None # face encodings for locations
+    matches = None # SearchResults from matching encodings
+
+    stored = None # results as stored in the ledger
+    recorded = False # True if the ledger already has this url
+    failed = False # True if the media could not be searched
+
+    previous = None # state of the smaller variant searched before reset
+
+    # what reset forgets and restore brings back
+    _variant_state = ( 'url', 'variant', 'data', 'digest', 'image', 'size',
+                       'original_size', 'hash', 'locations', 'encodings',
+                       'matches', 'stored' )
+
+    def __init__(self,tweet,url,index,media=None,variant=None):
+        self.tweet = tweet
+        self.url = url
+        self.key = url if media is None else media['media_url']
+        self.index = index
+        self.media = media
+        self.variant = variant
+
+    def reset(self,url,variant):
+        """
+        forget everything found so far to search another variant, keeping
+        it in previous to go back to if that variant cannot be searched
+        """
+        self.previous = dict( ( name, getattr(self,name) )
+                              for name in self._variant_state )
+        self.url = url
+        self.variant = variant
+        self.data = None
+        self.digest = None
+        self.image = None
+        self.size = None
+        self.original_size = None
+        self.hash = None
+        self.locations = None
+        self.encodings = None
+        self.matches = None
+        self.stored = None
+
+    def restore(self):
+        """
+        go back to the variant searched before the last reset, returns
+        False if there was none
+        """
+        if self.previous is None:
+            return False
+        for name,value in self.previous.items():
+            setattr(self,name,value)
+        self.previous = None
+        self.failed = False
+        return True
+
 class Searcher(object):
 
     known_photo = None
@@ -56,14 +333,65 @@ class Searcher(object):
 
     known_faces = None # filename, face encodings
     known_texts = None
+    text_matcher = None # KeywordMatcher for known_texts
+    text_word_boundary = True # only match whole words and phrases
+    text_casefold = True # match regardless of case
+
+    # the known faces as a (N_known x 128) matrix and a matching list of
+    # names, built once when the known photos are loaded
+    known_names = None
+    known_encodings = None
+    known_sqnorms = None # squared norm of each row of known_encodings
+
+    # maximum face distance to consider a match, same as the
+    # face_recognition.compare_faces default
+    match_tolerance = 0.6
+
+    photo_cache_file = None # file to cache known face encodings
 
     enable_cuda = False # default to not enabled
+
+    # faces are detected on a copy of the image scaled down to this long
+    # edge in pixels, 0 detects at full resolution
+    detect_long_edge = 1024
+    # smallest face in pixels in the full image that should be found, the
+    # detection resolution is raised to keep it findable
+    min_face_size = None
+    # detect again at full resolution when nothing is found scaled down
+    detect_escalate = False
+
+    # face detector, 'hog', 'cnn' or 'cascade'. the cascade finds candidate
+    # faces with hog and confirms them with cnn on crops around each one
+    detector = 'hog'
+    cascade_tiles = True # also look for small faces with hog on tiles
+    cascade_tile_size = 512 # tile size in pixels of the scaled image
+    # the upsampled hog tiles, and cnn when hog finds nothing, only cover
+    # the regions of the scaled image where at least this fraction of a
+    # cell of an 8 x 8 grid is skin colored, negative never runs them
+    cascade_skin_fraction = 0.25
+
+    # number of images per batched cnn detection call, 0 detects one image
+    # at a time
+    batch_size = 0
+
+    # MatchWriter that writes match files in the background, without one
+    # they are written straight away
+    writer = None
     
     def __init__(self,searchconfig):
 
         log.debug('Creating Searcher')
         
         # searchconfig should be dict-like with sections
+        try:
+            self.text_word_boundary = searchconfig['text word boundary'].lower() != 'no'
+        except KeyError:
+            self.text_word_boundary = Searcher.text_word_boundary
+        try:
+            self.text_casefold = searchconfig['text case fold'].lower() != 'no'
+        except KeyError:
+            self.text_casefold = Searcher.text_casefold
+
         try:
             searchtext = searchconfig['text']
             #log.debug('searching for ' + searchtext)
@@ -75,6 +403,18 @@ class Searcher(object):
         try: 
             searchphoto = searchconfig['photo']
             self.known_photo = searchphoto
+
+            # by default cache the known face encodings next to the
+            # known photos, set to 'no' to disable the cache
+            try:
+                photo_cache = searchconfig['photo cache']
+            except KeyError:
+                photo_cache = os.path.normpath(searchphoto) + '.encodings.npz'
+            if photo_cache.strip().lower() in ('', 'no', 'none'):
+                self.photo_cache_file = None
+            else:
+                self.photo_cache_file = photo_cache
+
             self.initPhotoSearch()
         except KeyError:
             searchphoto = None
@@ -93,6 +433,49 @@ class Searcher(object):
             self.enable_cuda = True
         else:
             self.enable_cuda = False
+
+        try:
+            self.match_tolerance = float(searchconfig['match tolerance'])
+        except KeyError:
+            self.match_tolerance = Searcher.match_tolerance
+
+        try:
+            self.detect_long_edge = int(searchconfig['detect long edge'])
+        except KeyError:
+            self.detect_long_edge = Searcher.detect_long_edge
+
+        try:
+            self.min_face_size = int(searchconfig['min face size'])
+        except KeyError:
+            self.min_face_size = None
+
+        try:
+            self.detect_escalate = searchconfig['detect escalate'].lower() == 'yes'
+        except KeyError:
+            self.detect_escalate = False
+
+        # without a detector setting, enable cuda picks the cnn detector
+        try:
+            self.detector = searchconfig['detector'].strip().lower()
+        except KeyError:
+            self.detector = 'cnn' if self.enable_cuda else 'hog'
+        if self.detector not in ('hog','cnn','cascade'):
+            raise SearcherError('Unknown detector ' + self.detector)
+
+        try:
+            self.cascade_tiles = searchconfig['cascade tiles'].lower() == 'yes'
+        except KeyError:
+            self.cascade_tiles = Searcher.cascade_tiles
+
+        try:
+            self.cascade_skin_fraction = float(searchconfig['cascade skin fraction'])
+        except KeyError:
+            self.cascade_skin_fraction = Searcher.cascade_skin_fraction
+
+        try:
+            self.batch_size = int(searchconfig['batch size'])
+        except KeyError:
+            self.batch_size = Searcher.batch_size
             
     def initPhotoSearch(self):
         # parse all the photos in the search photo dir and get search features
@@ -108,19 +491,38 @@ class Searcher(object):
             # find all files in the directory
             files = glob.glob(os.path.sep.join([self.known_photo,'*']))
 
+        # previously computed encodings are reused unless the file changed
+        if self.photo_cache_file:
+            cache = FaceCache(self.photo_cache_file)
+        else:
+            cache = None
+
         # run through the list of files and try to open and extract features
         # as well as file base names to use for text ID
         known_faces = [] 
         for _f in files:
 
+            fname = os.path.splitext(os.path.basename(_f))[0]
+
+            if cache is not None:
+                try:
+                    cached = cache.lookup(_f)
+                except OSError as e:
+                    # a broken link or a file removed during the scan
+                    log.warning('Could not read known photo ' + _f + ': ' + str(e))
+                    continue
+                if cached is not None:
+                    known_faces.append( [fname, cached] )
+                    continue
+
             try:
                 im = face_recognition.load_image_file(_f)
             except OSError:
                 # this case occurs if _f is not an image file
                 # keep going in case there's another file we might process
                 continue
-            
-            fname = os.path.splitext(os.path.basename(_f))[0]
+
+            log.debug('Encoding known face in ' + _f)
             face_encoding = face_recognition.face_encodings(im)
 
             # require each search photo to have one face only
@@ -137,128 +539,346 @@ class Searcher(object):
             # so use the first one
             known_faces.append( [fname, face_encoding[0] ] )
 
+            if cache is not None:
+                try:
+                    cache.store(_f, fname, face_encoding[0])
+                except OSError as e:
+                    # removed since it was read, it is just not cached
+                    log.warning('Could not cache known photo ' + _f + ': ' + str(e))
+
+        if cache is not None:
+            # forget photos that were removed from the known photo dir
+            cache.prune(files)
+            cache.save()
+
         if len(known_faces) == 0:
             raise SearcherError('No image files found in ' + self.known_photo)
             
         # put the known_faces into an attribute
         self.known_faces = known_faces
+
+        # keep all known encodings in one contiguous matrix for matching
+        self.known_names = [ _kf[0] for _kf in known_faces ]
+        self.known_encodings = np.ascontiguousarray(
+            np.stack([ _kf[1] for _kf in known_faces ]), dtype=np.float64 )
+        self.known_sqnorms = np.einsum('ij,ij->i',
+                                       self.known_encodings,
+                                       self.known_encodings)
+
+    def matchFaces(self,unknown_encodings,tolerance=None):
+        """
+        match face encodings against all of the known faces at once
+
+        unknown_encodings is a sequence or (N x 128) array of encodings,
+        which may come from one or several images
+
+        returns two arrays of length N, the index into known_names of the
+        closest known face and its distance. the index is -1 where the
+        closest known face is further away than tolerance, which defaults
+        to match_tolerance.
+        """
+
+        if self.known_encodings is None:
+            raise SearcherError('Known faces features must be initialized')
+
+        if tolerance is None:
+            tolerance = self.match_tolerance
+
+        unknown = np.asarray(unknown_encodings, dtype=np.float64)
+        if unknown.size == 0:
+            return np.zeros(0, dtype=np.intp), np.zeros(0)
+        unknown = unknown.reshape(-1, self.known_encodings.shape[1])
+
+        # squared euclidean distance matrix (N_unknown x N_known) from
+        # |u-k|^2 = |u|^2 + |k|^2 - 2 u.k
+        sqdist = self.known_sqnorms[np.newaxis,:] -\
+                 2.0 * unknown.dot(self.known_encodings.T)
+        sqdist += np.einsum('ij,ij->i', unknown, unknown)[:,np.newaxis]
+
+        best = np.argmin(sqdist, axis=1)
+        distance = np.sqrt(np.maximum(sqdist[np.arange(len(best)), best], 0.0))
+        best[distance > tolerance] = -1
+
+        return best, distance
+        
+    def detectScale(self,width,height):
+        """
+        return the scale, at most 1, to resize a (width x height) image to
+        for face detection
+        """
+        long_edge = max(width,height)
+        if self.detect_long_edge <= 0 or long_edge <= self.detect_long_edge:
+            return 1.0
+
+        scale = self.detect_long_edge / long_edge
+
+        # keep the smallest expected face big enough to detect
+        if self.min_face_size:
+            scale = max(scale, HOG_MIN_FACE / self.min_face_size)
+
+        return min(1.0, scale)
+
+    def detectLongEdge(self,width,height):
+        """
+        return the long edge in pixels a (width x height) image is scaled to
+        for face detection
+        """
+        return int(np.ceil( max(width,height) * self.detectScale(width,height) ))
+
+    def _faceLocations(self,im,model=None,upsample=1):
+        """ run a face detector on im, by default the configured one """
+        if model is None:
+            model = self.detector
+        if model == 'cascade':
+            return self.cascadeFaces(im)
+
+        return face_recognition.face_locations( im,
+                                                number_of_times_to_upsample = upsample,
+                                                model = model )
+
+    def _confirmFace(self,im,loc):
+        """
+        run the cnn detector on a crop around the candidate face loc in im
+
+        returns the cnn location of the face in im or None if the cnn does
+        not find a face there
+        """
+        height,width = im.shape[:2]
+        top,right,bottom,left = loc
+        pad = max(bottom-top, right-left) // 2
+        crop = ( max(0,top-pad), min(width,right+pad),
+                 min(height,bottom+pad), max(0,left-pad) )
+        sub = im[crop[0]:crop[2], crop[3]:crop[1]]
+
+        # bring small candidates up to a size the cnn finds with one upsample
+        scale = max(1.0, 2*HOG_MIN_FACE / float(max(1,bottom-top)))
+        if scale > 1.0:
+            sub = resizeImage(np.ascontiguousarray(sub),scale)
+        found = self._faceLocations(np.ascontiguousarray(sub),model='cnn')
+        if not found:
+            return None
+
+        # keep the cnn face closest to the candidate
+        found = [ scaleLocation(f,scale,crop[1]-crop[3],crop[2]-crop[0])
+                  for f in found ]
+        found = [ ( f[0]+crop[0], f[1]+crop[3], f[2]+crop[0], f[3]+crop[3] )
+                  for f in found ]
+        best = max(found, key = lambda f: boxOverlap(f,loc))
+        return best if boxOverlap(best,loc) > 0 else None
+
+    def cascadeFaces(self,im):
+        """
+        find faces in im with hog and confirm them with cnn, so the slow cnn
+        only runs on small crops of the image
+
+        - a hog pass on im
+        - a hog pass with extra upsampling for small faces, on tiles of the
+          regions of im that have enough skin color
+        - cnn on a crop around each candidate, candidates the cnn does not
+          confirm are dropped
+        - when hog finds nothing, cnn on the regions of im that have
+          enough skin color
+        """
+        candidates = self._faceLocations(im,model='hog')
+
+        if self.cascade_skin_fraction < 0:
+            regions = []
+        else:
+            regions = skinRegions(im,self.cascade_skin_fraction)
+
+        if self.cascade_tiles:
+            # upsampling quadruples the pixels hog scans, so it is kept to
+            # the parts of the image that may show people
+            size = self.cascade_tile_size
+            for rt,rr,rb,rl in regions:
+                for t in imageTiles(rr-rl,rb-rt,size,size//8):
+                    top,left = rt+t[0], rl+t[3]
+                    tile = np.ascontiguousarray(im[top:rt+t[2], left:rl+t[1]])
+                    metrics.count('cascade_tile_pixels', tile.shape[0]*tile.shape[1])
+                    for loc in self._faceLocations(tile,model='hog',upsample=2):
+                        candidates.append( ( loc[0]+top, loc[1]+left,
+                                             loc[2]+top, loc[3]+left ) )
+
+        candidates = mergeLocations(candidates)
+
+        if not candidates:
+            if not regions:
+                return []
+
+            # counted to see how much the fallback costs
+            metrics.count('cascade_fallbacks')
+            metrics.count('cascade_fallback_regions', len(regions))
+            metrics.count('cascade_fallback_pixels',
+                          sum( (b-t)*(r-l) for t,r,b,l in regions ))
+            log.debug('no hog candidates, running cnn on ' +\
+                      str(len(regions)) + ' skin colored regions')
+
+            found = []
+            for t,r,b,l in regions:
+                sub = np.ascontiguousarray(im[t:b, l:r])
+                for loc in self._faceLocations(sub,model='cnn'):
+                    found.append( ( loc[0]+t, loc[1]+l, loc[2]+t, loc[3]+l ) )
+            return mergeLocations(found)
+
+        confirmed = [ self._confirmFace(im,loc) for loc in candidates ]
+        log.debug('cnn confirmed ' + str(sum(c is not None for c in confirmed)) +\
+                  ' of ' + str(len(candidates)) + ' hog candidates')
+        return mergeLocations([ c for c in confirmed if c is not None ])
+
+    def detectFaces(self,im):
+        """
+        return the list of (top, right, bottom, left) locations of all the
+        faces found in im
+
+        detection runs on a scaled down copy of im, the locations are for
+        the full im
+        """
+        height,width = im.shape[:2]
+        scale = self.detectScale(width,height)
+        if scale >= 1.0:
+            return self._faceLocations(im)
+
+        locations = [ scaleLocation(loc,scale,width,height)
+                      for loc in self._faceLocations(resizeImage(im,scale)) ]
+
+        if not locations and self.detect_escalate:
+            # small faces may have been lost in the scaled down image
+            log.debug('no faces at scale ' + '%.2f' % scale +\
+                      ', detecting at full resolution')
+            locations = self._faceLocations(im)
+
+        return locations
+
+    def batchDetectFaces(self,images):
+        """
+        detect faces in several images with batched calls to the cnn
+        detector
+
+        each image is scaled to fit and letterboxed into a square frame of
+        the detection long edge so they all have the same size, as the
+        batched detector requires
+
+        returns a list with the face locations of each image
+        """
+        if self.detect_long_edge > 0:
+            frame = self.detect_long_edge
+        else:
+            frame = max( max(im.shape[:2]) for im in images )
+
+        frames = []
+        scales = []
+        for im in images:
+            height,width = im.shape[:2]
+            scale = min(1.0, frame / float(max(width,height)))
+            if scale < 1.0:
+                im = resizeImage(im,scale)
+            # pad at the bottom and right so boxes only need scaling back
+            boxed = np.zeros((frame,frame,3), dtype=np.uint8)
+            boxed[:im.shape[0],:im.shape[1]] = im
+            frames.append(boxed)
+            scales.append(scale)
+
+        batches = face_recognition.batch_face_locations( frames,
+                                                         batch_size = self.batch_size )
+
+        locations = []
+        for im,scale,found in zip(images,scales,batches):
+            height,width = im.shape[:2]
+            locations.append([ scaleLocation(loc,scale,width,height)
+                               for loc in found ])
+        return locations
+
+    def encodeFaces(self,im,face_locations):
+        """
+        return an (N x 128) array of encodings of the faces at face_locations
+        """
+        # there may be multiple faces in the test image
+        # for each item in the encodings, there is a corresponding
+        # face_locations, so a zip(encodings,face_locations) works
+        encodings = face_recognition.face_encodings(im, face_locations)
+        if not encodings:
+            return np.zeros((0,self.known_encodings.shape[1]))
+        return np.stack(encodings)
+
+    def matchEncodings(self,face_locations,encodings):
+        """
+        match the encodings of the faces at face_locations against the
+        known faces
+
+        returns a list of SearchResults for each matched face
+        """
+        # match all the faces in the image against the known faces in one go
+        best, distance = self.matchFaces(encodings)
+
+        # this returns a result only for known matches
+        return [ SearchResult( self.known_names[best[i]],
+                               tuple(face_locations[i]),
+                               distance = float(distance[i]) )
+                 for i in np.flatnonzero(best >= 0) ]
+
+    def drawMatches(self,im,matches,filename):
+        """
+        write im to filename with a rectangle drawn around each matched face
+
+        with a writer, the image is only converted, drawn on and encoded in
+        the background, so im must not be changed afterwards
+        """
+        boxes = [ _m.match_loc for _m in matches ]
+        if self.writer is not None:
+            self.writer.writeImage(filename, im, boxes)
+        else:
+            log.debug('writing ' + filename)
+            writeImage(filename, im, boxes)
         
     def searchPhoto(self,
                     im,
                     drawMatchFace = False):
         """
-        im has to be a numpy array, that is writable
+        im has to be an rgb uint8 numpy array
 
         drawMatchFace should be set to the name of a file to write
 
         returns a list of SearchResults for each matched face or unknown
         """
 
-        if self.enable_cuda:
-            model = 'cnn'
-        else:
-            model = 'hog'
-
         # check if known_faces features are ready
         if self.known_faces is None:
             raise SearcherError('Known faces features must be initialized')
 
         # find all the faces in the image
-        face_locations = face_recognition.face_locations( im, model = model )
+        face_locations = self.detectFaces(im)
 
         # encode the faces
-        # there may be multiple faces in the test image
-        # for each item in unknown_face_encodings, there is a corresponding
-        # face_locations, so a zip(unknown_face_encodings,face_locations) works
-        unknown_face_encodings = face_recognition.face_encodings(im, face_locations)
-
-        # test if the unknown face encodings match the known faces
-        matches = []
-
-        unknown_name = 'unknown'
-
-        if drawMatchFace:
-            pil_image = Image.fromarray(im)
-            draw = ImageDraw.Draw(pil_image)
-
-        # only set if we actually draw a rectange around a matched face
-        didDraw = False
-            
-        for iunknown,unknown_face in enumerate(unknown_face_encodings):
-
-            # this whole logic is too tortured and confused with too many
-            # list comprehensions... blegh.
-            
-            # m is a list of True/False if the unknown_face matches a known
-            # face
-            m = face_recognition.compare_faces(\
-                    [ _kfe[1] for _kfe in self.known_faces ],\
-                    unknown_face )
-
-            # any True in m are a match
-            # m_name is a list of names or 'unknown' if no face/name is matched
-            # to the unknown face found in the image
-            #
-            # this returned a results for all matches, including 'unknown'
-            #m_name = [ SearchResult( test[1][0] , face_locations[iunknown] ) \
-            #           if test[0] \
-            #           else SearchResult( unknown_name, face_locations[iunknown] )\
-            #           for test in zip(m,self.known_faces) ]
-
-            # this returns a result only for known matches
-            m_name = [ SearchResult( test[1][0] , face_locations[iunknown] ) \
-                       for test in zip(m,self.known_faces)\
-                       if test[0] ]
-
-            if drawMatchFace:
-                for _m in m_name:
-                    log.debug(str(_m))
-                    _m.reference = drawMatchFace
-                    if _m.match_name is not unknown_name:
-                        _m.reference = drawMatchFace
-                        log.debug('drawing ' + str(_m))
-                        didDraw = True
-                        # draw a rectange around the matching face
-                        top,right,bottom,left = _m.match_loc
-                        #face_locations[iunknown]
-                        draw.rectangle( ( ( left,top ), ( right, bottom) ),
-                                        outline = (0, 0, 255) )
-
-                        # add a label below the rectange
-                        #text_width, text_height = draw.textsize(_m)
-                        #draw.rectangle(((left, bottom - text_height - 10),
-                        #                (right, bottom)),
-                        #               fill=(0, 0, 255),
-                        #               outline=(0, 0, 255))
-                        #draw.text((left + 6, bottom - text_height - 5),
-                        #          _m,
-                        #          fill=(255, 255, 255, 255))
+        unknown_face_encodings = self.encodeFaces(im, face_locations)
 
-                
-            matches += m_name
+        matches = self.matchEncodings(face_locations, unknown_face_encodings)
 
-        if drawMatchFace and didDraw:
-            del draw
-            log.debug('writing ' + drawMatchFace)
-            pil_image.save(drawMatchFace)
+        if drawMatchFace and matches:
+            for _m in matches:
+                _m.reference = drawMatchFace
+            self.drawMatches(im, matches, drawMatchFace)
 
         # return matching names
         return matches 
 
     def initTextSearch(self):
 
-        # parse the search text into a list of strings
-        known_texts = self.search_text.lower().strip().split()
+        # parse the search text into a list of words and quoted phrases
+        known_texts = parseKeywords(self.search_text)
 
         self.known_texts = known_texts
 
+        # compile them all into one automaton so each text is scanned once
+        self.text_matcher = KeywordMatcher( known_texts,
+                                            word_boundary = self.text_word_boundary,
+                                            casefold = self.text_casefold )
+
     
     def searchText(self,text):
 
         match = []
-        for i,w in enumerate(self.known_texts):
-            if w in text.lower():
-                match.append( SearchResult(w, i) )
+        for i in self.text_matcher.search(text):
+            match.append( SearchResult(self.known_texts[i], i) )
 
         return match
 
@@ -268,53 +888,221 @@ class TweetSearcher(Searcher):
     photos, text, etc.
     """
 
+    downloader = None # MediaDownloader shared by all media requests
+
+    # number of upcoming tweets to prefetch media for while searching
+    prefetch_tweets = 0
+
+    ledger = None # Ledger of already searched tweets and media
+
+    # the smallest twitter size variant of each photo that is big enough
+    # for detection is downloaded first. a larger variant is downloaded
+    # when faces smaller than min_encode_face are found, or when no faces
+    # are found in a photo from one of the priority_feeds
+    min_encode_face = 50
+    priority_feeds = None
+
+    # results of images searched so far by perceptual hash, so that near
+    # duplicate images are only searched once
+    hash_index = None
+
+    # what is written to the photo match directory for a photo with
+    # matches. 'annotated' writes a copy with the faces marked, 'original'
+    # writes the downloaded file as is, named by its digest, with the face
+    # boxes only in the sidecar json
+    match_output = 'annotated'
+
     def __init__(self,searchconfig):
         Searcher.__init__(self,searchconfig)
 
-    def searchPhoto(self,
-                    im,
-                    tweet,
-                    drawMatchFace = False):
-        
-        # get search result from photoSearch base class
-        sr = super().searchPhoto(im,drawMatchFace=drawMatchFace)
+        # configure the media downloader
+        try:
+            threads = int(searchconfig['download threads'])
+        except KeyError:
+            threads = None
+        try:
+            timeout = float(searchconfig['download timeout'])
+        except KeyError:
+            timeout = None
+        try:
+            retries = int(searchconfig['download retries'])
+        except KeyError:
+            retries = None
+        self.downloader = MediaDownloader( threads = threads,
+                                           timeout = timeout,
+                                           retries = retries )
 
-        if sr:
-            for_json=dict()
-            for_json['tweet']=tweet._json
-            for_json['image_file'] = sr[0].reference
-            for_json['match_locs'] = []
-            for_json['match_name'] = []
+        try:
+            self.prefetch_tweets = int(searchconfig['prefetch tweets'])
+        except KeyError:
+            self.prefetch_tweets = self.downloader.threads
 
-            # add some metaata to the search results
-            for r in sr:
-                r.filename = r.reference
-                r.reference = tweet
-                for_json['match_locs'].append(r.match_loc)
-                for_json['match_name'].append(r.match_name)
+        self.ledger = Ledger.fromConfig(searchconfig)
 
-            # build a json file for this image to save with the image file
-            jsonfile = os.path.splitext(drawMatchFace)[0] + '.json'
-            with open(jsonfile,'w') as f:
-                json.dump(for_json,f)
+        # match files are written in the background
+        self.writer = MatchWriter.fromConfig(searchconfig)
 
-        return sr
-        
-    def searchTweet(self,tweet):
+        try:
+            self.match_output = searchconfig['match output'].strip().lower()
+        except KeyError:
+            self.match_output = TweetSearcher.match_output
+        if self.match_output not in ('annotated','original'):
+            raise SearcherError('Unknown match output ' + self.match_output)
+
+        try:
+            self.min_encode_face = int(searchconfig['min encode face size'])
+        except KeyError:
+            self.min_encode_face = TweetSearcher.min_encode_face
+
+        try:
+            self.priority_feeds = set( searchconfig['priority feeds'].lower().split() )
+        except KeyError:
+            self.priority_feeds = set()
+
+        # maximum number of differing hash bits to treat images as the
+        # same. only identical content is reused unless this is set, a
+        # negative number also turns off near duplicate detection
+        try:
+            duplicate_distance = int(searchconfig['duplicate distance'])
+        except KeyError:
+            duplicate_distance = -1
+        if duplicate_distance >= 0:
+            # kept no longer than the ledger keeps images, as a daemon
+            # holds the index for as long as it runs
+            if self.ledger is not None:
+                retention_days = self.ledger.retention_days
+            else:
+                retention_days = Ledger.retention_days
+            self.hash_index = HashIndex( max_distance = duplicate_distance,
+                                         retention = retention_days*24*60*60 )
+            if self.ledger is not None:
+                for h,size,results,processed in self.ledger.images():
+                    self.hash_index.add(h,size,results,added=processed)
+                log.debug('Loaded ' + str(len(self.hash_index)) +\
+                          ' image hashes from ledger')
+
+    def close(self):
+        """ release the resources held by the searcher """
+        self.writer.close()
+        self.downloader.close()
+        if self.ledger is not None:
+            self.ledger.close()
+
+    @staticmethod
+    def tweetMedia(tweet):
+        """ return the list of media entities attached to a tweet """
+
+        # check if there is an extended_entities attribute which will
+        # specifiy multiple media
+        try:
+            entities = tweet.extended_entities
+        except AttributeError:
+            entities = tweet.entities
+
+        # extract the media from the entities
+        try:
+            return entities['media']
+        except KeyError:
+            # no media key present, so no media to match
+            return []
+
+    def prefetchTweet(self,tweet):
+        """ start downloading the media of a tweet in the background """
+        items = self.mediaItems(tweet)
+        if self.ledger is not None:
+            if self.ledger.hasTweet(tweet.id_str):
+                return
+            items = [ item for item in items
+                      if self.ledger.mediaResults(item.key) is None ]
+        self.downloader.prefetch([ item.url for item in items ])
+
+    @staticmethod
+    def storedResults(stored,tweet):
         """
-        search a tweet for configured search parameters
-        tweet is a tweepy Status object or list of tweepy
-        status objects
+        convert results stored by the ledger back to SearchResults for tweet
+        """
+        return [ SearchResult( name, tuple(loc),
+                               reference = tweet,
+                               distance = distance )
+                 for name,loc,distance in stored ]
 
-        returns a list of matches
+    def prefetched(self,tweets):
+        """
+        generator that yields tweets in order while prefetching the media of
+        the next prefetch_tweets tweets
         """
+        window = collections.deque()
+        for tweet in tweets:
+            self.prefetchTweet(tweet)
+            window.append(tweet)
+            if len(window) > self.prefetch_tweets:
+                yield window.popleft()
+        while window:
+            yield window.popleft()
+
+    def writeSidecar(self,tweet,matches,image_file,jsonfile=None,
+                     match_locs=None,**extra):
+        """
+        write a json file, by default next to image_file, describing the
+        matches found in it. match_locs are the face boxes in image_file
+        if they differ from those of the matches, extra items are added to
+        the json as they are
+        """
+        if match_locs is None:
+            match_locs = [ r.match_loc for r in matches ]
+
+        for_json=dict()
+        for_json['tweet']=tweet._json
+        for_json['image_file'] = image_file
+        for_json['match_locs'] = match_locs
+        for_json['match_name'] = [ r.match_name for r in matches ]
+        for_json.update(extra)
+
+        # build a json file for this image to save with the image file
+        if jsonfile is None:
+            jsonfile = os.path.splitext(image_file)[0] + '.json'
+        self.writer.writeJson(jsonfile,for_json)
+
+    def writeMatchFiles(self,item,sr):
+        """
+        write the files for the matches sr found in item to the photo match
+        directory, returns the image file written
+        """
+        # each photo of a tweet gets its own files, the first keeps the
+        # name used before tweets had more than one
+        name = 'tweet_' + item.tweet.id_str
+        if item.index:
+            name += '_' + str(item.index)
+        name = os.path.sep.join([self.photo_match_dir, name])
+
+        if self.match_output == 'annotated':
+            image_file = name + '.jpg'
+            self.drawMatches(item.image, sr, image_file)
+            self.writeSidecar(item.tweet, sr, image_file)
+            return image_file
+
+        # the same photo in several tweets is written once. the boxes are
+        # mapped from the decoded image to the downloaded one
+        image_file = os.path.sep.join([self.photo_match_dir,
+                                       item.digest + imageExtension(item.data)])
+        self.writer.writeContent(image_file, item.data)
+        self.writeSidecar( item.tweet, sr, image_file,
+                           jsonfile = name + '.json',
+                           match_locs = [ rescaleLocation( r.match_loc,
+                                                           item.size,
+                                                           item.original_size )
+                                          for r in sr ],
+                           image_size = list(item.original_size),
+                           media_url = item.url,
+                           distance = [ r.distance for r in sr ] )
+        return image_file
+
+    def searchTweetText(self,tweet):
+        """
+        search the text of a tweet, writing the text out if it matches
 
-        try:
-            m = [ self.searchTweet(_t) for _t in tweet ]
-            return m
-        except TypeError:
-            pass
-            
+        returns a list of matches
+        """
         try:
             tweettext = tweet.text
         except AttributeError:
@@ -325,56 +1113,391 @@ class TweetSearcher(Searcher):
         # should get empty list if no match
         textmatch = Searcher.searchText(self,tweettext)
 
-        if textmatch:
+        for r in textmatch:
+            r.reference = tweet
+        metrics.count('text_matches', len(textmatch))
+
+        if textmatch and self.photo_match_dir:
             log.debug('found match in ' + tweettext)
             # found a text match, write out the match as a text file
             textMatchFile = os.path.sep.join([self.photo_match_dir,
                                               'tweet_'+tweet.id_str + '.txt'])
-            with open(textMatchFile,'w') as f:
-                f.write(tweettext)
-                
-        # check if there is an extended_entities attribute which will
-        # specifiy multiple media
+            self.writer.writeText(textMatchFile,tweettext)
+
+        return textmatch
+
+    def mediaItems(self,tweet):
+        """ return a MediaItem for each photo to search in a tweet """
+        if self.known_faces is None:
+            # not configured to search photos
+            return []
+
+        # this assumes the media are photos
+        items = []
+        for i,m in enumerate(self.tweetMedia(tweet)):
+            url, variant = self.selectVariant(m)
+            items.append( MediaItem(tweet, url, i,
+                                    media = m, variant = variant) )
+        return items
+
+    @staticmethod
+    def _variants(m):
+        """
+        return the (long edge, name) of the twitter size variants of media
+        m that are scaled to fit, smallest first
+        """
         try:
-            entities = tweet.extended_entities
-        except AttributeError:
-            entities = tweet.entities
+            sizes = m['sizes']
+        except (KeyError, TypeError):
+            return []
+        return sorted( ( max(v['w'],v['h']), name )
+                       for name,v in sizes.items()
+                       if v.get('resize','fit') == 'fit' )
+
+    def selectVariant(self,m,larger_than=None):
+        """
+        return the (url, variant name) of the smallest size variant of media
+        m that is big enough for face detection, or of the next size up
+        from the variant larger_than. returns (None, None) if there is no
+        larger variant and (media_url, None) if m has no size variants.
+        """
+        variants = self._variants(m)
+        if not variants:
+            if larger_than is not None:
+                return None, None
+            return m['media_url'], None
+
+        if larger_than is not None:
+            names = [ name for edge,name in variants ]
+            try:
+                i = names.index(larger_than)
+            except ValueError:
+                return None, None
+            if i+1 == len(variants):
+                return None, None
+            name = variants[i+1][1]
+            return m['media_url'] + ':' + name, name
+
+        # the largest variant stands for the original image
+        edge, name = variants[-1]
+        big = m['sizes'][name]
+        needed = self.detectLongEdge(big['w'],big['h'])
+        for edge,name in variants:
+            if edge >= needed:
+                break
+        return m['media_url'] + ':' + name, name
+
+    def largerVariant(self,item):
+        """
+        if the item should be searched again at a larger size, switch it to
+        the next larger variant and return True
+        """
+        if item.variant is None or item.matches is None or item.failed:
+            return False
+
+        if item.locations:
+            # faces were found, are they big enough to encode reliably
+            smallest = min( bottom-top for top,right,bottom,left in item.locations )
+            if smallest >= self.min_encode_face:
+                return False
+            reason = 'faces too small'
+        elif item.tweet.user.screen_name.lower() in self.priority_feeds:
+            reason = 'no faces in priority feed'
+        else:
+            return False
+
+        url, variant = self.selectVariant(item.media, larger_than = item.variant)
+        if url is None:
+            return False
+
+        log.debug(reason + ' in ' + item.url + ', trying ' + variant)
+        item.reset(url, variant)
+        return True
+
+    # each of the media steps below fills in more of a MediaItem. a step
+    # returns True when the item was resolved without needing the
+    # remaining steps, e.g. from the ledger, and recordMedia is next.
+
+    def lookupMedia(self,item):
+        """ resolve the item from the ledger by url """
+        # the same media shows up in retweets and quote tweets
+        if self.ledger is not None:
+            stored = self.ledger.mediaResults(item.key)
+            if stored is not None:
+                log.debug('using ledger results for ' + item.key)
+                item.stored = stored
+                item.recorded = True
+                return True
+        return False
+
+    def downloadMedia(self,item):
+        """ download the item and resolve it from the ledger by content """
+        try:
+            with metrics.timer('download'):
+                item.data = self.downloader.get(item.url)
+        except DownloaderError as e:
+            log.warning(str(e))
+            metrics.count('download_errors')
+            item.failed = True
+            return True
+        metrics.count('downloads')
+        metrics.count('download_bytes', len(item.data))
+
+        item.digest = digestBytes(item.data)
+        if self.ledger is not None:
+            stored = self.ledger.digestResults(item.digest)
+            if stored is not None:
+                log.debug('using ledger results for content of ' + item.url)
+                item.stored = stored
+                return True
+        return False
+
+    def decodeMedia(self,item):
+        """ decode the item and resolve it if it duplicates a known image """
+        # decode straight at the size faces are detected at, unless the
+        # detection may escalate to full resolution
+        if self.detect_escalate:
+            long_edge = None
+        else:
+            long_edge = self.detectLongEdge
 
-        # extract the media from the entities
+        # this assumes an image - need to handle video
+        # appear to receive a thumbnail in case of video
         try:
-            media = entities['media']
-        except KeyError:
-            # no media key present, so no media to match
-            media = []
-            mediamatches = []
+            with metrics.timer('decode'):
+                item.image, item.original_size = decodeImage(item.data,long_edge)
+        except OSError as e:
+            log.warning('Could not decode ' + item.url + ': ' + str(e))
+            item.failed = True
+            return True
+
+        item.size = ( item.image.shape[1], item.image.shape[0] )
+
+        # a near duplicate of an image already searched has the same
+        # faces, so reuse its results scaled to this image. a tiny image
+        # has too few pixels to hash and is just searched
+        if self.hash_index is not None and canHash(item.image):
+            item.hash = dhash(item.image)
+            found = self.hash_index.lookup(item.hash,item.size)
+            if found is not None:
+                log.debug('using results of a duplicate image for ' + item.url)
+                item.stored = [ [ name,
+                                  rescaleLocation(loc,found[0],item.size),
+                                  distance ]
+                                for name,loc,distance in found[1] ]
+                return True
+        return False
+
+    def detectMedia(self,item):
+        """ find and encode the faces in the item """
+        with metrics.timer('detect'):
+            item.locations = self.detectFaces(item.image)
+        with metrics.timer('encode'):
+            item.encodings = self.encodeFaces(item.image, item.locations)
+
+    def matchMedia(self,item):
+        """ match the faces in the item against the known faces """
+        with metrics.timer('match'):
+            item.matches = self.matchEncodings(item.locations, item.encodings)
+
+    def matchMediaBatch(self,items):
+        """ match the faces of several items against the known faces at once """
+        counts = [ len(item.encodings) for item in items ]
+        if sum(counts) == 0:
+            for item in items:
+                item.matches = []
+            return
+
+        encodings = np.concatenate([ item.encodings for item in items
+                                     if len(item.encodings) ])
+        with metrics.timer('match'):
+            best, distance = self.matchFaces(encodings)
+
+        start = 0
+        for item,n in zip(items,counts):
+            item.matches = [ SearchResult( self.known_names[best[start+i]],
+                                           tuple(item.locations[i]),
+                                           distance = float(distance[start+i]) )
+                             for i in range(n) if best[start+i] >= 0 ]
+            start += n
+
+    def recordMedia(self,item):
+        """
+        write out the matches for the item and record it in the ledger
 
-        # media is now a list of items we can parse for urls
-        for m in media:
-            # this assumes the media are photos
-            
-            url = m['media_url']
-            # this assumes an image - need to handle video
-            # appear to receive a thumbnail in case of video
-            im = Image.open(requests.get(url, stream=True).raw)
-            npim = np.asarray(im)
-            
-            # if url points to a jpeg, everything is hunky dory
-            # if url points to a png, the image comesback with an alpha channel
-            # which needs to be removed, this is an issue in the dlib library, see:
-            # https://github.com/davisking/dlib/issues/128
-            npimc = npim[:, :, :3].copy()
+        returns a list of SearchResults for the item
+        """
+        if item.failed and item.restore():
+            # the faces matched in the smaller variant still count
+            log.debug('could not search a larger variant of ' + item.key +\
+                      ', keeping the results of ' + item.variant)
+            metrics.count('variant_errors')
+        # the smaller variant is not needed any more
+        item.previous = None
+
+        if item.failed:
+            metrics.count('images_failed')
+            return []
+
+        if item.matches is None:
+            # resolved without searching
+            metrics.count('images_reused')
+            sr = self.storedResults(item.stored,item.tweet)
+        else:
+            metrics.count('images_searched')
+            metrics.count('faces', len(item.locations))
+            sr = item.matches
+            for r in sr:
+                r.reference = item.tweet
 
             # find all known faces in this image
-            if self.photo_match_dir:
-                drawFaceName = os.path.sep.join([self.photo_match_dir,
-                                                 'tweet_' + tweet.id_str + '.jpg'])
-            else:
-                drawFaceName = False
+            if sr and self.photo_match_dir:
+                image_file = self.writeMatchFiles(item, sr)
+                for r in sr:
+                    r.filename = image_file
+
+            item.stored = [ [r.match_name, r.match_loc, r.distance] for r in sr ]
+            if self.hash_index is not None:
+                self.hash_index.add(item.hash,item.size,item.stored)
+            if self.ledger is not None and self.hash_index is not None:
+                self.ledger.addImage(item.hash,item.size,item.stored)
 
+        if self.ledger is not None and not item.recorded:
+            self.ledger.addMedia(item.key,item.digest,item.stored)
+
+        metrics.count('face_matches', len(sr))
+        return sr
+
+    def searchMedia(self,item):
+        """ run all the media steps on one item, returns its SearchResults """
+        if not self.lookupMedia(item):
+            while not ( self.downloadMedia(item) or
+                        self.decodeMedia(item) ):
+                self.detectMedia(item)
+                self.matchMedia(item)
+                if not self.largerVariant(item):
+                    break
+        return self.recordMedia(item)
+
+    def finishTweet(self,tweet,items=()):
+        """
+        record that all of a tweet was searched. a tweet with media items
+        that could not be searched, e.g. a download that timed out, is not
+        recorded so its media are searched again on the next run
+        """
+        if any( item.failed for item in items ):
+            log.debug('not recording tweet ' + tweet.id_str +\
+                      ', some of its media could not be searched')
+            metrics.count('tweets_incomplete')
+            return
+        metrics.count('tweets_searched')
+        if self.ledger is not None:
+            self.ledger.addTweet(tweet.id_str)
+
+    def alreadySearched(self,tweet):
+        """ return True if the tweet was searched on an earlier run """
+        if self.ledger is not None and self.ledger.hasTweet(tweet.id_str):
+            log.debug('skipping already searched tweet ' + tweet.id_str)
+            metrics.count('tweets_skipped')
+            return True
+        return False
+        
+    def searchTweet(self,tweet):
+        """
+        search a tweet for configured search parameters
+        tweet is a tweepy Status object or list of tweepy
+        status objects
+
+        returns a list of matches
+        """
+
+        try:
+            m = [ self.searchTweet(_t) for _t in tweet ]
+            return m
+        except TypeError:
+            pass
+
+        if self.alreadySearched(tweet):
+            # already searched and reported on an earlier run
+            return []
+
+        textmatch = self.searchTweetText(tweet)
+                
+        mediamatches = []
+        items = self.mediaItems(tweet)
+        for item in items:
             # this returns multiple matches per image if multiple faces match
-            mediamatches = self.searchPhoto( npimc,
-                                             tweet,
-                                             drawMatchFace = drawFaceName)
+            mediamatches += self.searchMedia(item)
+
+        self.finishTweet(tweet,items)
 
         # returns a list of matches
         return mediamatches+textmatch
+
+    def searchTweetBatch(self,tweets):
+        """
+        search several tweets, detecting faces in all of their photos with
+        batched cnn detection when batch size is set for the cnn detector
+
+        returns a list of the matches of each tweet
+        """
+        if not self.batch_size or self.detector != 'cnn':
+            return [ self.searchTweet(tweet) for tweet in tweets ]
+
+        # get every photo as far as detection
+        entries = []
+        pending = []
+        for tweet in tweets:
+            if self.alreadySearched(tweet):
+                entries.append(None)
+                continue
+            textmatch = self.searchTweetText(tweet)
+            items = self.mediaItems(tweet)
+            for item in items:
+                if not ( self.lookupMedia(item) or
+                         self.downloadMedia(item) or
+                         self.decodeMedia(item) ):
+                    pending.append(item)
+            entries.append( (tweet, textmatch, items) )
+
+        if pending:
+            log.debug('batch detecting faces in ' + str(len(pending)) + ' images')
+            with metrics.timer('detect_batch'):
+                locations = self.batchDetectFaces([ item.image for item in pending ])
+            for item,locs in zip(pending,locations):
+                item.locations = locs
+                with metrics.timer('encode'):
+                    item.encodings = self.encodeFaces(item.image, locs)
+            self.matchMediaBatch(pending)
+
+            # the few photos needing a larger variant are searched singly
+            for item in pending:
+                while self.largerVariant(item):
+                    if self.downloadMedia(item) or self.decodeMedia(item):
+                        break
+                    self.detectMedia(item)
+                    self.matchMedia(item)
+
+        # fan the matches back out to their tweets
+        results = []
+        for entry in entries:
+            if entry is None:
+                results.append([])
+                continue
+            tweet, textmatch, items = entry
+            mediamatches = []
+            for item in items:
+                mediamatches += self.recordMedia(item)
+            self.finishTweet(tweet,items)
+            results.append(mediamatches+textmatch)
+
+        return results
+
+    def searchTweetBatchResults(self,tweets):
+        """
+        search tweets like searchTweetBatch, but return a list of
+        TweetResults for each tweet that can be sent back from a worker
+        process
+        """
+        return [ [ TweetResult(sr) for sr in matches ]
+                 for matches in self.searchTweetBatch(tweets) ]
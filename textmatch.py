@@ -0,0 +1,130 @@
+"""
+textmatch.py
+
+match many keywords and phrases against text in a single pass with an
+aho-corasick automaton, so the cost of searching a tweet does not grow
+with the number of keywords.
+"""
+import logging
+log = logging.getLogger(__name__)
+
+import re
+
+# a double quoted phrase or a single word
+_TERM = re.compile(r'"([^"]*)"|(\S+)')
+
+def parseKeywords(text):
+    """
+    split search text into keywords. words in double quotes are kept
+    together as one phrase, e.g. cat "new york" -> ['cat', 'new york']
+    """
+    keywords = []
+    for phrase,word in _TERM.findall(text):
+        keyword = ' '.join(phrase.split()) if phrase else word
+        if keyword and keyword not in keywords:
+            keywords.append(keyword)
+    return keywords
+
+def _isWordChar(c):
+    return c.isalnum() or c == '_'
+
+class KeywordMatcher(object):
+    """
+    class to find which of a list of keywords occur in a text
+
+    the automaton is a trie of the keywords with failure links. each node
+    is a dict of transitions, the failure node and the indices of the
+    keywords ending there.
+    """
+
+    keywords = None
+    word_boundary = True # only match whole words and phrases
+    casefold = True # match regardless of case, including unicode folds
+
+    def __init__(self,keywords,word_boundary=None,casefold=None):
+        self.keywords = list(keywords)
+        if word_boundary is not None:
+            self.word_boundary = word_boundary
+        if casefold is not None:
+            self.casefold = casefold
+
+        self._goto = [ dict() ]
+        self._fail = [ 0 ]
+        self._out = [ [] ]
+        self._length = [] # length of each normalized keyword
+
+        for i,keyword in enumerate(self.keywords):
+            self._add(i, self.normalize(keyword))
+        self._link()
+
+        log.debug('Built keyword matcher with ' + str(len(self._goto)) +\
+                  ' states for ' + str(len(self.keywords)) + ' keywords')
+
+    def normalize(self,text):
+        """ fold case if enabled and collapse runs of whitespace """
+        if self.casefold:
+            text = text.casefold()
+        return ' '.join(text.split())
+
+    def _add(self,index,keyword):
+        node = 0
+        for c in keyword:
+            nxt = self._goto[node].get(c)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[node][c] = nxt
+                self._goto.append(dict())
+                self._fail.append(0)
+                self._out.append([])
+            node = nxt
+        self._out[node].append(index)
+        self._length.append(len(keyword))
+
+    def _link(self):
+        """ set the failure links breadth first """
+        level = list(self._goto[0].values())
+        while level:
+            nextlevel = []
+            for node in level:
+                for c,child in self._goto[node].items():
+                    fail = self._fail[node]
+                    while fail and c not in self._goto[fail]:
+                        fail = self._fail[fail]
+                    self._fail[child] = self._goto[fail].get(c, 0)
+                    # a keyword ending at the failure node ends here too
+                    self._out[child] = self._out[child] + self._out[self._fail[child]]
+                    nextlevel.append(child)
+            level = nextlevel
+
+    def search(self,text):
+        """
+        return the sorted indices into keywords of the keywords found in
+        text
+        """
+        text = self.normalize(text)
+        goto = self._goto
+        fail = self._fail
+        out = self._out
+
+        found = set()
+        node = 0
+        for end,c in enumerate(text):
+            while node and c not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(c, 0)
+            for index in out[node]:
+                if index in found:
+                    continue
+                if self.word_boundary:
+                    # only word characters at the ends of a keyword need a
+                    # boundary, so #tags and @names still match
+                    start = end - self._length[index] + 1
+                    if start > 0 and _isWordChar(text[start]) and\
+                       _isWordChar(text[start-1]):
+                        continue
+                    if end+1 < len(text) and _isWordChar(c) and\
+                       _isWordChar(text[end+1]):
+                        continue
+                found.add(index)
+
+        return sorted(found)
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+"""
+thumbnails.py
+
+render small crops of the matched faces described by match sidecar json
+files, for reviewing matches written with match output = original, which
+only stores the downloaded photo and the face boxes. also works for the
+annotated copies.
+
+Usage:
+  thumbnails.py [options] SIDECAR...
+
+Options:
+  -h --help            Show this screen.
+  --size=<px>          long edge of the thumbnails in pixels [default: 128]
+  --margin=<frac>      extra space around each face, as a fraction of the
+                       face size [default: 0.25]
+  --output=<dir>       directory to write the thumbnails to, defaults to the
+                       directory of each sidecar
+"""
+import logging
+log = logging.getLogger(__name__)
+
+import os
+import json
+
+from lazy import LazyModule
+Image = LazyModule('PIL.Image')
+
+def sidecarImage(sidecar_file,sidecar):
+    """
+    return the image file of a sidecar, looking next to the sidecar if the
+    match directory has been moved
+    """
+    image_file = sidecar['image_file']
+    if not os.path.exists(image_file):
+        image_file = os.path.join( os.path.dirname(sidecar_file),
+                                   os.path.basename(image_file) )
+    return image_file
+
+def faceThumbnails(sidecar_file,size=128,margin=0.25):
+    """
+    return a list of (match name, PIL image) of a thumbnail of each matched
+    face in the sidecar json file
+    """
+    with open(sidecar_file) as f:
+        sidecar = json.load(f)
+
+    im = Image.open(sidecarImage(sidecar_file,sidecar))
+    im = im.convert('RGB')
+    width,height = im.size
+
+    thumbs = []
+    for name,(top,right,bottom,left) in zip(sidecar['match_name'],
+                                            sidecar['match_locs']):
+        dx = int((right - left) * margin)
+        dy = int((bottom - top) * margin)
+        box = ( max(0, left - dx), max(0, top - dy),
+                min(width, right + dx), min(height, bottom + dy) )
+        thumb = im.crop(box)
+        thumb.thumbnail( (size,size) )
+        thumbs.append( (name,thumb) )
+    return thumbs
+
+def writeThumbnails(sidecar_file,output_dir=None,size=128,margin=0.25):
+    """
+    write a jpeg of each matched face in the sidecar json file, named after
+    the sidecar, the face and the match name. returns the files written
+    """
+    if output_dir is None:
+        output_dir = os.path.dirname(sidecar_file)
+    base = os.path.splitext(os.path.basename(sidecar_file))[0]
+
+    filenames = []
+    for i,(name,thumb) in enumerate(faceThumbnails(sidecar_file,size,margin)):
+        filename = os.path.join( output_dir,
+                                 base + '_face' + str(i) + '_' +\
+                                 name.replace(os.path.sep,'_') + '.jpg' )
+        thumb.save(filename, format = 'JPEG')
+        filenames.append(filename)
+    return filenames
+
+if __name__=='__main__':
+
+    from docopt import docopt
+    args = docopt(__doc__)
+
+    size = int(args['--size'])
+    margin = float(args['--margin'])
+    if args['--output']:
+        os.makedirs(args['--output'], exist_ok=True)
+
+    for sidecar_file in args['SIDECAR']:
+        for filename in writeThumbnails( sidecar_file,
+                                         output_dir = args['--output'],
+                                         size = size,
+                                         margin = margin ):
+            print(filename)
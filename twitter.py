@@ -9,10 +9,184 @@ import sys
 import tweepy
 
 import datetime
+import json
+import os
+import time
+import heapq
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import metrics
+from atomicfile import atomicFile
 
 class TwitterError(object):
     pass
 
+# length of a twitter rate limit window in seconds
+RATE_LIMIT_WINDOW = 15*60
+
+class RateLimiter(object):
+    """
+    class to track the user_timeline rate limit window from the headers of
+    the responses, shared by all the threads fetching tweets
+
+    a request is let through while the window has requests left. once the
+    window is used up, requests wait until it resets instead of failing.
+    """
+
+    margin = 5 # seconds to wait past the reset time
+
+    remaining = None # requests left in this window, None until known
+    reset = None # time the window resets, seconds since the epoch
+
+    def __init__(self,margin=None):
+        if margin is not None:
+            self.margin = margin
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """ wait until a request may be made and count it """
+        while True:
+            with self.lock:
+                now = time.time()
+                if self.reset is not None and now >= self.reset + self.margin:
+                    # a new window, the next response tells its budget
+                    self.remaining = None
+                    self.reset = None
+                if self.remaining is None or self.remaining > 0:
+                    if self.remaining is not None:
+                        self.remaining -= 1
+                    return
+                delay = self.reset + self.margin - now
+
+            log.info('Twitter rate limit reached, waiting ' + str(int(delay)) +\
+                     ' seconds')
+            metrics.count('twitter_rate_limit_waits')
+            with metrics.timer('twitter_rate_limit_wait'):
+                time.sleep(delay)
+
+    def _headers(self,response):
+        try:
+            headers = response.headers
+            return ( int(headers['x-rate-limit-remaining']),
+                     int(headers['x-rate-limit-reset']) )
+        except ( AttributeError, KeyError, TypeError, ValueError ):
+            return None, None
+
+    def update(self,response):
+        """ note the rate limit window given in a response """
+        remaining, reset = self._headers(response)
+        if remaining is None:
+            return
+        with self.lock:
+            # responses of requests made earlier in the same window may
+            # arrive late, so only ever lower the count within a window
+            if reset == self.reset and self.remaining is not None:
+                self.remaining = min(self.remaining, remaining)
+            else:
+                self.remaining = remaining
+                self.reset = reset
+        metrics.gauge('twitter_rate_limit_remaining', remaining)
+
+    def limited(self,response):
+        """ note that twitter refused a request for the rate limit """
+        remaining, reset = self._headers(response)
+        if reset is None:
+            reset = time.time() + RATE_LIMIT_WINDOW
+        with self.lock:
+            self.remaining = 0
+            self.reset = reset
+
+class FeedCursor(object):
+    """
+    class to page back through the timeline of one feed, newest first
+    """
+
+    screen_name = None
+    nToGet = None # maximum number of tweets to retrieve
+    start_date = None
+    end_date = None
+    since_id = None
+    weight = 1.0 # share of the requests given to this feed
+
+    nGot = 0 # number of tweets retrieved
+    nFound = 0 # number of tweets in the time frame
+    pages = 0 # number of pages retrieved
+    oldest = None # max_id for the next page
+    done = False
+
+    # only 200 tweets can be retrieved at a time
+    nPerTry = 200
+
+    def __init__(self,screen_name,nToGet,start_date=None,end_date=None,
+                 since_id=None,weight=None):
+        self.screen_name = screen_name
+        self.nToGet = nToGet
+        self.start_date = start_date
+        self.end_date = end_date
+        self.since_id = since_id
+        if weight is not None:
+            self.weight = weight
+        self.done = nToGet <= 0
+
+    def score(self):
+        """ feeds with the lowest score get the next request """
+        return self.pages / self.weight
+
+    def request(self):
+        """ return the user_timeline arguments for the next page """
+
+        # how many to get this time?
+        nThisTime = min(self.nPerTry, self.nToGet - self.nGot)
+
+        kwargs = dict( screen_name = self.screen_name,
+                       count = nThisTime,
+                       include_rts = True,
+                       tweet_mode = 'extended' )
+        if self.oldest is not None:
+            # need to keep track of max_id and look for older id's
+            kwargs['max_id'] = self.oldest
+        if self.since_id is not None:
+            kwargs['since_id'] = self.since_id
+        return kwargs
+
+    def consume(self,new_tweets):
+        """
+        advance past a page of tweets, return the ones in the time frame
+        """
+        log.debug('Got ' + str(len(new_tweets)) + ' tweets before time frame check')
+        self.pages += 1
+
+        # if no tweets retuned, then we got the most
+        if len(new_tweets) == 0:
+            self.done = True
+            return []
+
+        # loop over all the tweets and see if they fit with in the
+        # requested time line
+        found = []
+        for _tweet in new_tweets:
+            if self.start_date and _tweet.created_at < self.start_date:
+                continue
+            if self.end_date and _tweet.created_at > self.end_date:
+                continue
+            found.append(_tweet)
+        self.nFound += len(found)
+
+        self.nGot += len(new_tweets)
+        self.oldest = new_tweets[-1].id - 1
+
+        # once a page reaches back past the start date, all older pages
+        # are outside of the time frame too
+        if self.nGot >= self.nToGet or \
+           ( self.start_date and new_tweets[-1].created_at < self.start_date ):
+            self.done = True
+        if self.done:
+            log.debug('Found ' + str(self.nFound) + ' tweets in ' + str(self.screen_name))
+
+        return found
+
 class Twitter(object):
 
     consumer_key = None
@@ -23,9 +197,20 @@ class Twitter(object):
     feeds_to_follow = None
 
     max_per_feed = None
+
+    # file to store the newest tweet id seen in each feed, so only newer
+    # tweets are fetched on the next run
+    state_file = None
+    since_ids = None # dict of screen name -> newest tweet id
     
     # twitter api object
     api = None
+
+    # number of threads fetching feeds at the same time, each with its own
+    # api object. they share one rate limiter
+    fetch_threads = 4
+    limiter = None # RateLimiter for user_timeline
+    feed_weights = None # dict of screen name -> share of requests
     
     def __init__(self,twitter_dict):
 
@@ -36,6 +221,8 @@ class Twitter(object):
         self.access_token_secret = twitter_dict['access token secret']
 
         # open the twitter api
+        self._local = threading.local()
+        self._lock = threading.Lock()
         self.openApi()
         
         # create a list of feeds to follow
@@ -48,14 +235,53 @@ class Twitter(object):
             self.max_per_feed = int(twitter_dict['max per feed'])
         except KeyError:
             self.max_per_feed = sys.maxsize
+
+        try:
+            self.state_file = twitter_dict['state file']
+        except KeyError:
+            self.state_file = None
+        self.loadState()
+
+        try:
+            self.fetch_threads = int(twitter_dict['fetch threads'])
+        except KeyError:
+            self.fetch_threads = Twitter.fetch_threads
+
+        # weights are given as name:weight, unlisted feeds have weight 1
+        self.feed_weights = dict()
+        try:
+            for _w in twitter_dict['feed weights'].split():
+                name, weight = _w.rsplit(':',1)
+                self.feed_weights[name.lower()] = float(weight)
+        except KeyError:
+            pass
+
+        try:
+            margin = float(twitter_dict['rate limit margin'])
+        except KeyError:
+            margin = None
+        self.limiter = RateLimiter(margin)
             
     def openApi(self):
         """ open the twitter api """
+        self.api = self._newApi()
+        self._local.api = self.api
 
+    def _newApi(self):
         auth = tweepy.OAuthHandler(self.consumer_key, self.consumer_secret )
         auth.set_access_token( self.access_token, self.access_token_secret )
-        api = tweepy.API(auth)
-        self.api = api
+        return tweepy.API(auth)
+
+    def threadApi(self):
+        """
+        return the api object of the calling thread, the api keeps the last
+        response so it can not be shared between threads
+        """
+        try:
+            return self._local.api
+        except AttributeError:
+            self._local.api = self._newApi()
+            return self._local.api
 
     def getApi(self):
         # return the api for external use
@@ -65,101 +291,152 @@ class Twitter(object):
                   screen_name,
                   nToGet = None,
                   start_date = None,
-                  end_date = None):
+                  end_date = None,
+                  since_id = None):
+        """
+        return a list of the tweets for screen name, see iterTweets for the
+        arguments
+        """
+        return list( self.iterTweets( screen_name,
+                                      nToGet = nToGet,
+                                      start_date = start_date,
+                                      end_date = end_date,
+                                      since_id = since_id ) )
+
+    def iterTweets(self,
+                   screen_name,
+                   nToGet = None,
+                   start_date = None,
+                   end_date = None,
+                   since_id = None):
         """ 
-        return tweets for screen name. currently get max possible which is
+        generator of tweets for screen name. currently get max possible which is
         3240. 
         Modeled after: https://gist.github.com/yanofsky/5436496
 
         nToGet is the number to return, (default) means get max tweets, in practice,
         limited by twitter's max of 3240
 
-        returns a list of all the tweets
+        yields the tweets one page at a time as they are retrieved, newest
+        first
 
         date time objects
         start_date = None - get tweets since the start date
         end_date = None - get tweets before the end date
+
+        since_id = None - only get tweets newer than this tweet id, defaults
+        to the newest tweet seen for this feed in the state file
         """
 
+        cursor = self.feedCursor( screen_name,
+                                  nToGet = nToGet,
+                                  start_date = start_date,
+                                  end_date = end_date,
+                                  since_id = since_id )
+        while not cursor.done:
+            for _tweet in self.fetchPage(cursor):
+                yield _tweet
+
+    def feedCursor(self,
+                   screen_name,
+                   nToGet = None,
+                   start_date = None,
+                   end_date = None,
+                   since_id = None):
+        """ return a FeedCursor for screen name, see iterTweets """
+
         if nToGet is None:
             nToGet = self.max_per_feed
 
+        if since_id is None:
+            since_id = self.since_ids.get(screen_name)
+
         log.debug('Getting up to ' + str(nToGet) + ' tweets from ' + screen_name )
-        log.debug('   from ' + str(start_date) + ' to ' + str(end_date) )
-            
-        alltweets = [] # list to hold tweet
-        nGot = 0 # number of tweets retrieved
-
-        # only 200  tweets can be retrieved at a time
-        nPerTry = 200
-
-        # get the first batch of tweets
-        nThisTime = nToGet if nToGet <= nPerTry else nPerTry
-        new_tweets = self.api.user_timeline(screen_name = screen_name,
-                                            count = nThisTime,
-                                            include_rts = True,
-                                            tweet_mode = 'extended' )
-
-        ret_tweets = []
-        if not start_date and not end_date:
-            ret_tweets = new_tweets
-        else:
-            for _tweet in new_tweets:
-                if _tweet.created_at >= start_date and\
-                   _tweet.created_at <= end_date:
-                    ret_tweets.append(_tweet)
+        log.debug('   from ' + str(start_date) + ' to ' + str(end_date) +\
+                  ' since id ' + str(since_id) )
 
-        # loop over all the tweets and see if they fit with in the
-        # requested time line
-        
-        
-        log.debug('Got ' + str(len(new_tweets)) + ' tweets before time frame check')
-        
-        if len(ret_tweets) == 0:
-            # nothng returned - return empty list
-            return ret_tweets
+        return FeedCursor( screen_name, nToGet,
+                           start_date = start_date,
+                           end_date = end_date,
+                           since_id = since_id,
+                           weight = self.feed_weights.get(screen_name.lower()) )
 
-        alltweets.extend(ret_tweets)
-        
-        oldest = new_tweets[-1].id - 1
-        #nToGet -= nThisTime
-        nGot += nThisTime
-        
-        while nGot < nToGet:
-            # keep getting tweets until we have the number we want
+    def fetchPage(self,cursor):
+        """ fetch the next page of a feed, return its tweets in the time frame """
+        new_tweets = self.userTimeline(**cursor.request())
 
-            # how many to get this time?
-            nThisTime = nPerTry if (nToGet - nGot) > nPerTry else (nToGet - nGot)
-            
-            new_tweets = self.api.user_timeline(screen_name = screen_name,
-                                                count = nThisTime,
-                                                max_id = oldest,
-                                                include_rts = True,
-                                                tweet_mode='extended')
+        # tweets come back newest first, so the first page holds the
+        # newest tweet in this feed
+        if cursor.pages == 0 and len(new_tweets) > 0:
+            self.noteNewest(cursor.screen_name, new_tweets[0].id)
 
-            log.debug('Got ' + str(len(new_tweets)) + ' tweets before time frame check')
+        return cursor.consume(new_tweets)
 
-            ret_tweets = []
-            if not start_date and not end_date:
-                ret_tweets = new_tweets
+    def userTimeline(self,**kwargs):
+        """
+        get one page of a user timeline within the rate limit, waiting for
+        the rate limit window to reset when it is used up
+        """
+        api = self.threadApi()
+        while True:
+            self.limiter.acquire()
+            try:
+                with metrics.timer('twitter_page'):
+                    new_tweets = api.user_timeline(**kwargs)
+            except tweepy.TweepError as e:
+                response = getattr(e,'response',None)
+                if isinstance(e,tweepy.RateLimitError) or \
+                   getattr(response,'status_code',None) == 429:
+                    self.limiter.limited(response)
+                    continue
+                raise
+            self.limiter.update(api.last_response)
+            metrics.count('tweets_fetched', len(new_tweets))
+            return new_tweets
+
+    def noteNewest(self,screen_name,tweet_id):
+        """ record tweet_id as seen if it is the newest for screen_name """
+        with self._lock:
+            if tweet_id > self.since_ids.get(screen_name, 0):
+                self.since_ids[screen_name] = tweet_id
+
+    def forgetNewest(self,cursor):
+        """
+        go back to the newest tweet id seen for a feed before this run, so
+        tweets a failed feed did not get to are fetched on the next run
+        """
+        with self._lock:
+            if cursor.since_id is None:
+                self.since_ids.pop(cursor.screen_name, None)
             else:
-                for _tweet in new_tweets:
-                    if _tweet.created_at >= start_date and\
-                       _tweet.created_at <= end_date:
-                        ret_tweets.append(_tweet)
-            
-            # if no tweets retuned, then we got the most
-            if len(ret_tweets) == 0: break
-            
-            # need to keep track of max_id and look for older id's
-            oldest = new_tweets[-1].id - 1
-            
-            nGot += len(new_tweets)
+                self.since_ids[cursor.screen_name] = cursor.since_id
+
+    def loadState(self):
+        """ read the newest tweet id seen for each feed from the state file """
+
+        self.since_ids = dict()
+        if not self.state_file or not os.path.isfile(self.state_file):
+            return
 
-            alltweets.extend(ret_tweets)
+        with open(self.state_file) as f:
+            state = json.load(f)
+
+        self.since_ids = { k : int(v) for k,v in state['since_id'].items() }
+        log.debug('Loaded since ids for ' + str(len(self.since_ids)) + ' feeds')
+
+    def saveState(self):
+        """
+        write the newest tweet id seen for each feed to the state file.
+        call this once the fetched tweets have been processed so that an
+        interrupted run fetches them again.
+        """
 
-        log.debug('Found ' + str(len(alltweets)) + ' tweets in ' + str(screen_name))
-        return alltweets
+        if not self.state_file:
+            return
+
+        with atomicFile(self.state_file) as f:
+            json.dump( { 'since_id' : self.since_ids }, f )
+        log.debug('Saved since ids to ' + self.state_file)
     
     def getAllTweets(self,sinceDays=None):
         """
@@ -167,6 +444,14 @@ class Twitter(object):
 
         may take a while
         """
+        return list( self.iterAllTweets( sinceDays = sinceDays ) )
+
+    def iterAllTweets(self,sinceDays=None):
+        """
+        generator of all the tweets possible for the current configuration,
+        feed by feed and page by page so searching can start on the first
+        page
+        """
 
         if sinceDays:
             log.debug('Getting tweets since last ' + str(sinceDays) + ' days.')
@@ -177,12 +462,56 @@ class Twitter(object):
             today = None
             start_date = None
             
-        # loop over all the feeds in feeds_to_follow
-        alltweets=[]
-        for feed in self.feeds_to_follow:
-            feedtweets = self.getTweets(feed,
-                                        start_date = start_date,
-                                        end_date = today)
-            alltweets.extend(feedtweets)
-
-        return alltweets
+        cursors = [ self.feedCursor( feed,
+                                     start_date = start_date,
+                                     end_date = today )
+                    for feed in self.feeds_to_follow ]
+
+        if self.fetch_threads <= 1:
+            # loop over all the feeds in feeds_to_follow
+            for cursor in cursors:
+                while not cursor.done:
+                    for _tweet in self.fetchPage(cursor):
+                        yield _tweet
+        else:
+            for _tweet in self.iterConcurrently(cursors):
+                yield _tweet
+
+    def iterConcurrently(self,cursors):
+        """
+        generator of the tweets of several feeds, fetched by a pool of
+        threads
+
+        one page per feed is in flight at a time. the next request goes to
+        the waiting feed with the fewest pages for its weight, so a feed
+        with a long timeline does not hold up the others and when the rate
+        limit is reached, the budget of the window was spread over the
+        feeds. a feed that fails is logged and dropped.
+        """
+        seq = itertools.count()
+        ready = [ ( c.score(), next(seq), c ) for c in cursors ]
+        heapq.heapify(ready)
+        inflight = dict()
+
+        with ThreadPoolExecutor( max_workers = self.fetch_threads,
+                                 thread_name_prefix = 'fetch' ) as executor:
+            while ready or inflight:
+                while ready and len(inflight) < self.fetch_threads:
+                    _, _, cursor = heapq.heappop(ready)
+                    inflight[ executor.submit(self.fetchPage, cursor) ] = cursor
+
+                done, _ = wait(inflight, return_when = FIRST_COMPLETED)
+                for future in done:
+                    cursor = inflight.pop(future)
+                    try:
+                        new_tweets = future.result()
+                    except tweepy.TweepError:
+                        log.exception('Could not get tweets from ' + cursor.screen_name)
+                        metrics.count('twitter_feed_errors')
+                        self.forgetNewest(cursor)
+                        continue
+
+                    if not cursor.done:
+                        heapq.heappush(ready, ( cursor.score(), next(seq), cursor ))
+                    for _tweet in new_tweets:
+                        yield _tweet
@@ -0,0 +1,170 @@
+"""
+writer.py
+
+write the files describing matches, annotated images or the original
+media, json sidecars and matched tweet text, on a small background
+thread pool so that searching never waits on the disk or on encoding
+jpegs. images are only converted and drawn on once they are being
+written, after a match was confirmed. files are written with atomicfile
+so a reader of the match directory never sees one partly written.
+
+no more than max_pending writes are queued at once, each holding on to
+its image, so a disk that cannot keep up slows the search down instead
+of filling memory.
+"""
+import logging
+log = logging.getLogger(__name__)
+
+import os
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from lazy import LazyModule
+Image = LazyModule('PIL.Image')
+ImageDraw = LazyModule('PIL.ImageDraw')
+
+import metrics
+from atomicfile import atomicFile, writeAtomic
+
+def annotateImage(im,boxes):
+    """
+    return a PIL image of the rgb numpy array im with a rectangle drawn
+    around each (top, right, bottom, left) box
+    """
+    pil_image = Image.fromarray(im)
+    draw = ImageDraw.Draw(pil_image)
+    for top,right,bottom,left in boxes:
+        draw.rectangle( ( ( left,top ), ( right, bottom) ),
+                        outline = (0, 0, 255) )
+    del draw
+    return pil_image
+
+def writeImage(filename,im,boxes,quality=None):
+    """ write im to filename as a jpeg with the boxes drawn on it """
+    kwargs = dict()
+    if quality is not None:
+        kwargs['quality'] = quality
+    pil_image = annotateImage(im,boxes)
+    with atomicFile(filename,'wb') as f:
+        pil_image.save(f, format = 'JPEG', **kwargs)
+
+def writeContent(filename,data):
+    """
+    write the bytes data to filename unless it is already there, for files
+    named by a digest of their content
+    """
+    if os.path.exists(filename):
+        return
+    writeAtomic(filename,data)
+
+# leading bytes of the image formats twitter serves
+_SIGNATURES = ( ( b'\xff\xd8\xff', '.jpg' ),
+                ( b'\x89PNG', '.png' ),
+                ( b'GIF8', '.gif' ) )
+
+def imageExtension(data,default='.jpg'):
+    """ return the file extension for the image file bytes data """
+    for signature,ext in _SIGNATURES:
+        if data.startswith(signature):
+            return ext
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return '.webp'
+    return default
+
+def writeJson(filename,obj):
+    with atomicFile(filename) as f:
+        json.dump(obj,f)
+
+class MatchWriter(object):
+    """
+    class to write match files in the background
+    """
+
+    threads = 2 # number of concurrent writes
+    max_pending = 32 # maximum number of queued writes
+    jpeg_quality = 75 # quality of the annotated jpegs, 1 to 95
+
+    executor = None
+
+    def __init__(self,
+                 threads = None,
+                 max_pending = None,
+                 jpeg_quality = None):
+
+        if threads is not None:
+            self.threads = threads
+        if max_pending is not None:
+            self.max_pending = max_pending
+        if jpeg_quality is not None:
+            self.jpeg_quality = jpeg_quality
+
+        self.executor = ThreadPoolExecutor( max_workers = self.threads,
+                                            thread_name_prefix = 'writer' )
+        self._cond = threading.Condition()
+        self._pending = 0
+
+    @classmethod
+    def fromConfig(cls,searchconfig):
+        """ return a MatchWriter set up from the search configuration """
+        try:
+            threads = int(searchconfig['write threads'])
+        except KeyError:
+            threads = None
+        try:
+            max_pending = int(searchconfig['write queue'])
+        except KeyError:
+            max_pending = None
+        try:
+            jpeg_quality = int(searchconfig['jpeg quality'])
+        except KeyError:
+            jpeg_quality = None
+        return cls( threads = threads,
+                    max_pending = max_pending,
+                    jpeg_quality = jpeg_quality )
+
+    def _submit(self,fn,filename,*args):
+        with self._cond:
+            if self._pending >= self.max_pending:
+                metrics.count('write_waits')
+            while self._pending >= self.max_pending:
+                self._cond.wait()
+            self._pending += 1
+        self.executor.submit(self._write,fn,filename,args)
+
+    def _write(self,fn,filename,args):
+        try:
+            log.debug('writing ' + filename)
+            with metrics.timer('write'):
+                fn(filename,*args)
+            metrics.count('files_written')
+        except Exception:
+            log.exception('Could not write ' + filename)
+            metrics.count('write_errors')
+        finally:
+            with self._cond:
+                self._pending -= 1
+                self._cond.notify_all()
+
+    def writeImage(self,filename,im,boxes):
+        """
+        queue im to be written to filename as a jpeg with the boxes drawn
+        on it. im must not be changed afterwards
+        """
+        self._submit(writeImage,filename,im,list(boxes),self.jpeg_quality)
+
+    def writeContent(self,filename,data):
+        """ queue the bytes data to be written to filename if not there """
+        self._submit(writeContent,filename,data)
+
+    def writeJson(self,filename,obj):
+        """ queue obj to be written to filename as json """
+        self._submit(writeJson,filename,obj)
+
+    def writeText(self,filename,text):
+        """ queue text to be written to filename """
+        self._submit(writeAtomic,filename,text)
+
+    def close(self):
+        """ finish the queued writes and stop the threads """
+        self.executor.shutdown(wait = True)